@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+from types import SimpleNamespace
+from typing import Dict, List
+
+# Run from a scratch directory so bot.log, sessions/ and the database stay out of the repo
+BENCH_DIR = tempfile.mkdtemp(prefix="bot_bench_")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(BENCH_DIR)
+
+import bot
+from pyrogram.errors import FloodWait
+
+
+# Stand-in for pyrogram's Client with simulated latency and FloodWait injection
+class FakeClient:
+    def __init__(self, name: str, options: argparse.Namespace):
+        self.name = name
+        self.options = options
+        self.is_connected = False
+        self.sent = 0
+
+    async def start(self):
+        await asyncio.sleep(self.options.connect_latency)
+        self.is_connected = True
+
+    async def stop(self):
+        self.is_connected = False
+
+    async def rpc(self):
+        await asyncio.sleep(self.options.rpc_latency)
+        if random.random() < self.options.flood_rate:
+            raise FloodWait(value=self.options.flood_seconds)
+        self.sent += 1
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        await self.rpc()
+        return SimpleNamespace(id=self.sent)
+
+    async def edit_message_text(self, chat_id, message_id, text):
+        await self.rpc()
+
+    async def send_media(self, kind: str, media: str):
+        if os.path.exists(media):
+            await asyncio.sleep(self.options.upload_latency)
+        await self.rpc()
+        return SimpleNamespace(**{kind: SimpleNamespace(file_id=f"{self.name}:{media}")})
+
+    async def send_photo(self, chat_id, photo, caption=None):
+        return await self.send_media("photo", photo)
+
+    async def send_video(self, chat_id, video, caption=None):
+        return await self.send_media("video", video)
+
+    async def send_document(self, chat_id, document, caption=None):
+        return await self.send_media("document", document)
+
+
+class FakeSessionPool(bot.SessionPool):
+    def __init__(self, loop: asyncio.AbstractEventLoop, options: argparse.Namespace):
+        super().__init__(loop)
+        self.options = options
+
+    def build_client(self, session_name: str) -> FakeClient:
+        return FakeClient(session_name, self.options)
+
+
+# Keeps raw scheduler lag samples so percentiles are exact
+class RecordingMetrics(bot.Metrics):
+    def __init__(self):
+        super().__init__()
+        self.lag: List[float] = []
+
+    def observe(self, name: str, value: float, **labels):
+        if name == "bot_scheduler_lag_seconds":
+            self.lag.append(value)
+        super().observe(name, value, **labels)
+
+
+# Minimal pyrogram Message stand-in for driving handlers
+class FakeMessage:
+    def __init__(self, text: str):
+        self.text = text
+        self.replies: List[str] = []
+
+    async def reply(self, text: str, reply_markup=None):
+        self.replies.append(text)
+        return self
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Fresh database, session files and bot globals for one scenario
+async def setup(name: str, options: argparse.Namespace, sessions: int) -> float:
+    bot.SESSION_DIR = os.path.join(BENCH_DIR, name, "sessions")
+    os.makedirs(bot.SESSION_DIR, exist_ok=True)
+    for i in range(sessions):
+        open(os.path.join(bot.SESSION_DIR, f"bench_{i}.session"), "w").close()
+    bot.metrics = RecordingMetrics()
+    bot.health = bot.HealthTracker()
+    bot.history = bot.DeliveryHistory()
+    bot.db = bot.Database(os.path.join(BENCH_DIR, name, "schedules.db"))
+    await bot.db.open()
+    loop = asyncio.get_running_loop()
+    bot.pool = FakeSessionPool(loop, options)
+    bot.dispatcher = bot.Dispatcher(bot.pool)
+    bot.pool.on_change = bot.dispatcher.sync_workers
+    bot.scheduler = bot.Scheduler()
+    bot.recurring = bot.RecurringRegistry(loop)
+    start = time.perf_counter()
+    await bot.pool.start()
+    return time.perf_counter() - start
+
+
+async def teardown():
+    for job_id in list(bot.recurring.jobs):
+        bot.recurring.remove(job_id)
+    for worker in bot.dispatcher.workers.values():
+        worker.cancel()
+    await asyncio.gather(*bot.dispatcher.workers.values(), return_exceptions=True)
+    await bot.pool.stop()
+    await bot.db.close()
+
+
+# Deliver a backlog of one-time schedules that are all due at once
+async def bench_pending(options: argparse.Namespace) -> Dict[str, float]:
+    await setup("pending", options, options.sessions)
+    try:
+        now = int(time.time())
+        rows = [("-100123", f"pending {i}", None, now, False, now) for i in range(options.pending)]
+        async with bot.db.transaction() as conn:
+            await conn.executemany(
+                """
+                INSERT INTO schedules (chat_id, text, media_path, schedule_time, is_recurring, next_run_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                rows
+            )
+        start = time.perf_counter()
+        await bot.scheduler.load()
+        load_time = time.perf_counter() - start
+        runner = asyncio.create_task(bot.scheduler.run(bot.dispatcher))
+        while len(bot.metrics.lag) < options.pending:
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+        runner.cancel()
+        lag = bot.metrics.lag
+        return {
+            "schedules": options.pending,
+            "load_seconds": load_time,
+            "throughput_per_second": options.pending / elapsed,
+            "lag_p50_seconds": percentile(lag, 50),
+            "lag_p99_seconds": percentile(lag, 99),
+        }
+    finally:
+        await teardown()
+
+
+# Keep many short-interval recurring jobs firing for a fixed duration
+async def bench_recurring(options: argparse.Namespace) -> Dict[str, float]:
+    await setup("recurring", options, options.sessions)
+    try:
+        media_path = os.path.join(BENCH_DIR, "recurring", "media.jpg")
+        with open(media_path, "wb") as f:
+            f.write(os.urandom(256 * 1024))
+        now = time.time()
+        for i in range(options.recurring):
+            # Every tenth job posts media to exercise the file_id cache
+            job = bot.RecurringJob(i + 1, "-100123", f"recurring {i}", media_path if i % 10 == 0 else None, 1)
+            bot.recurring.add(job, now + random.random())
+        await asyncio.sleep(options.duration)
+        lag = bot.metrics.lag
+        return {
+            "jobs": options.recurring,
+            "runs": len(lag),
+            "throughput_per_second": len(lag) / options.duration,
+            "lag_p50_seconds": percentile(lag, 50),
+            "lag_p99_seconds": percentile(lag, 99),
+        }
+    finally:
+        await teardown()
+
+
+# Time pool startup and the schedule handlers against a populated table
+async def bench_handlers(options: argparse.Namespace) -> Dict[str, float]:
+    startup = await setup("handlers", options, options.sessions)
+    try:
+        start = time.perf_counter()
+        for i in range(options.handler_calls):
+            await bot.schedule_message(None, FakeMessage(f"/schedule -100123 2099-01-01 12:00 message{i}"))
+        schedule_time = time.perf_counter() - start
+        start = time.perf_counter()
+        listing = FakeMessage("/listschedules")
+        await bot.list_schedules(None, listing)
+        list_time = time.perf_counter() - start
+        return {
+            "sessions": options.sessions,
+            "startup_seconds": startup,
+            "schedule_per_second": options.handler_calls / schedule_time,
+            "listschedules_seconds": list_time,
+            "listschedules_reply_chars": sum(len(r) for r in listing.replies),
+        }
+    finally:
+        await teardown()
+
+
+SCENARIOS = {
+    "pending": bench_pending,
+    "recurring": bench_recurring,
+    "handlers": bench_handlers,
+}
+
+
+async def run(options: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name in options.scenarios:
+        results[name] = await SCENARIOS[name](options)
+        results[name]["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for bot.py using a fake pyrogram Client")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--pending", type=int, default=100000)
+    parser.add_argument("--recurring", type=int, default=500)
+    parser.add_argument("--handler-calls", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run the recurring scenario")
+    parser.add_argument("--rpc-latency", type=float, default=0.002)
+    parser.add_argument("--connect-latency", type=float, default=0.05)
+    parser.add_argument("--upload-latency", type=float, default=0.2)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability an RPC raises FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    options = parser.parse_args(argv)
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    options.scenarios = options.scenarios or list(SCENARIOS)
+    return options
+
+
+def main(argv: List[str]):
+    options = parse_args(argv)
+    random.seed(0)
+    results = asyncio.run(run(options))
+    if options.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, result in results.items():
+        print(f"[{name}]")
+        for key, value in result.items():
+            print(f"  {key}: {value:.4f}" if isinstance(value, float) else f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,27 +1,102 @@
 import os
+import sys
+import csv
+import json
+import time
+import queue
+import atexit
 import logging
 import signal
-import schedule
+import io
+import heapq
+import bisect
+import functools
+import random
+import hashlib
+import cProfile
+import pstats
+import threading
+import traceback
 import asyncio
+import argparse
+import sqlite3
 import aiosqlite
+from collections import defaultdict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
-from typing import List, Optional, Tuple
-from pyrogram import Client, filters, enums
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from pyrogram.errors import (
-    FloodWait,
-    RPCError,
-    AuthKeyUnregistered,
-    SessionRevoked,
-    UserDeactivatedBan
-)
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+# Logging settings: rotate by size, or by time when LOG_ROTATE_WHEN is set (e.g. "midnight")
+LOG_PATH = "bot.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_ROTATE_WHEN: Optional[str] = None
+LOG_JSON = False
+# Most sampled records (per-send lines) written per second; the rest are counted
+SAMPLED_LOG_RATE = 20
+
+# One JSON object per line, with session/chat/schedule_id when a record carries them
+class JsonFormatter(logging.Formatter):
+    FIELDS = ("session", "chat", "schedule_id")
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry, default=str)
+
+# Caps records logged with extra={"sampled": True} to a fixed rate per second
+class SampledRateFilter(logging.Filter):
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        self.window = 0
+        self.count = 0
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False):
+            return True
+        window = int(record.created)
+        if window != self.window:
+            if self.suppressed:
+                record.msg = f"{record.msg} ({self.suppressed} similar lines suppressed)"
+            self.window, self.count, self.suppressed = window, 0, 0
+        self.count += 1
+        if self.count > self.rate:
+            self.suppressed += 1
+            return False
+        return True
+
+# Coroutines only enqueue records; a listener thread formats and writes them
+def setup_logging() -> QueueListener:
+    if LOG_ROTATE_WHEN:
+        file_handler = TimedRotatingFileHandler(LOG_PATH, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT)
+    else:
+        file_handler = RotatingFileHandler(LOG_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    if LOG_JSON:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SampledRateFilter(SAMPLED_LOG_RATE))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
 # Configure logging
-logging.basicConfig(
-    filename="bot.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # Telegram API credentials
@@ -34,98 +109,1702 @@ ADMIN_ID = 6257711894
 SESSION_DIR = "sessions"
 if not os.path.exists(SESSION_DIR):
     os.makedirs(SESSION_DIR)
+# Uploads are staged here, on the same filesystem but outside the *.session scan
+UPLOAD_DIR = os.path.join(SESSION_DIR, "uploads")
+if not os.path.exists(UPLOAD_DIR):
+    os.makedirs(UPLOAD_DIR)
+
+# Only files in here can be attached by /schedule and /recurring, named with a trailing media=<file>
+MEDIA_DIR = "media"
+MEDIA_ARG = "media="
+if not os.path.exists(MEDIA_DIR):
+    os.makedirs(MEDIA_DIR)
 
 # SQLite database for schedules
 DB_PATH = "schedules.db"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Delay before retrying a one-time schedule that could not be queued
+SCHEDULE_RETRY_SECONDS = 60
+
+# Failed one-time deliveries are retried with exponential backoff and jitter, then marked failed
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BACKOFF_BASE = 30
+OUTBOX_BACKOFF_MAX = 3600
+
+# What a recurring job does with runs that come due while its last run is still sending,
+# or that were missed while the bot was down: "skip" drops them, "coalesce" runs once,
+# "catchup" runs every missed slot in turn (at most MISFIRE_CATCHUP_LIMIT)
+MISFIRE_POLICY = "coalesce"
+MISFIRE_GRACE_SECONDS = 30
+MISFIRE_CATCHUP_LIMIT = 10
+
+# Maximum number of due schedules fetched per dispatch query
+DISPATCH_BATCH_SIZE = 100
+
+# Session connects run in parallel up to this limit, each with its own deadline
+MAX_CONCURRENT_CONNECTS = 10
+SESSION_CONNECT_TIMEOUT = 30
+
+# Most session clients kept connected at once; the rest are parked and connected on demand
+MAX_CONNECTED_CLIENTS = 50
+# A session told to wait longer than this gives its slot to a parked one
+FLOOD_EVICT_SECONDS = 300
+# Connected sessions unused this long are parked, freeing their slot for parked ones
+SESSION_IDLE_SECONDS = 600
+SESSION_IDLE_CHECK_SECONDS = 60
+
+# Maximum number of sends in flight across all sessions
+MAX_CONCURRENT_SENDS = 10
+
+# Window for batching delivered schedules into one commit
+FLUSH_INTERVAL_SECONDS = 1
+
+# Session validation limits and how long a result is reused for the same file
+MAX_CONCURRENT_VALIDATIONS = 5
+VALIDATION_TIMEOUT_SECONDS = 30
+VALIDATION_CACHE_TTL = 600
+
+# How long a resolved @username is trusted before it is resolved again
+PEER_CACHE_TTL = 24 * 3600
+
+# Delivery history: raw rows are kept HISTORY_RETENTION_DAYS days, daily rollups ROLLUP_RETENTION_DAYS
+HISTORY_RETENTION_DAYS = 14
+ROLLUP_RETENTION_DAYS = 180
+HISTORY_FLUSH_SECONDS = 5
+HISTORY_PRUNE_INTERVAL_SECONDS = 3600
+# Most free pages returned to the filesystem per prune
+VACUUM_PAGES = 1000
+# Rows per section in /stats
+STATS_TOP_N = 10
+
+# Background admin jobs: how many run at once, how often progress is edited in, how many are kept
+MAX_CONCURRENT_JOBS = 3
+JOB_PROGRESS_INTERVAL = 2
+JOB_HISTORY = 20
+
+# /listschedules page size and how much of each message text to show
+LIST_PAGE_SIZE = 10
+LIST_PREVIEW_CHARS = 40
+
+# Prometheus text file written periodically for node_exporter's textfile collector
+METRICS_PATH = "metrics.prom"
+METRICS_INTERVAL_SECONDS = 15
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Loop watchdog: a heartbeat is scheduled every LOOP_WATCHDOG_INTERVAL; when it is more than
+# LOOP_BLOCK_THRESHOLD late, a thread logs the stack of whatever is holding the loop
+LOOP_WATCHDOG_INTERVAL = 0.1
+LOOP_BLOCK_THRESHOLD = 0.5
+
+# Longest /profile capture and how many functions its report lists
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP_FUNCTIONS = 40
+
+# In-process counters, gauges and latency histograms in Prometheus text format
+class Metrics:
+    def __init__(self):
+        self.counters: Dict[Tuple[str, tuple], float] = defaultdict(float)
+        self.gauges: Dict[Tuple[str, tuple], float] = {}
+        self.histograms: Dict[Tuple[str, tuple], List[float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    # Histogram state is one count per bucket plus +Inf, then the sum and total count
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        state = self.histograms.get(key)
+        if state is None:
+            state = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 3)
+        state[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def format_labels(labels: tuple, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{self.format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (series_name, labels), state in sorted(self.histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), state):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append(f"{name}_bucket{self.format_labels(labels, (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {state[-2]}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {state[-1]}")
+        return "\n".join(lines) + "\n"
+
+    # Write the text file atomically so scrapers never read a partial file
+    def write(self, path: str):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+metrics = Metrics()
+
+# Record how long an admin command handler takes
+def timed_command(command: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(client, update):
+            with metrics.timer("bot_command_seconds", command=command):
+                return await func(client, update)
+        return wrapper
+    return decorator
+
+# Original schedules table
+async def create_schedules_table(conn: aiosqlite.Connection):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            media_path TEXT,
+            schedule_time TEXT,
+            interval_seconds INTEGER,
+            is_recurring BOOLEAN NOT NULL
+        )
+    """)
+
+# Store due times as integer UTC epochs and index the next run of every row
+async def migrate_epoch_schedule_times(conn: aiosqlite.Connection):
+    await conn.execute("""
+        CREATE TABLE schedules_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            media_path TEXT,
+            schedule_time INTEGER,
+            interval_seconds INTEGER,
+            is_recurring BOOLEAN NOT NULL,
+            next_run_at INTEGER
+        )
+    """)
+    cursor = await conn.execute(
+        "SELECT id, chat_id, text, media_path, schedule_time, interval_seconds, is_recurring FROM schedules"
+    )
+    now = int(time.time())
+    rows = []
+    for schedule_id, chat_id, text, media_path, schedule_time, interval, is_recurring in await cursor.fetchall():
+        if is_recurring:
+            due, next_run_at = None, now + interval
+        else:
+            try:
+                due = int(datetime.strptime(schedule_time, TIME_FORMAT).timestamp())
+            except (TypeError, ValueError):
+                logger.warning(f"Schedule {schedule_id} has invalid time {schedule_time!r}, sending now")
+                due = now
+            next_run_at = due
+        rows.append((schedule_id, chat_id, text, media_path, due, interval, is_recurring, next_run_at))
+    await conn.executemany(
+        """
+        INSERT INTO schedules_new
+            (id, chat_id, text, media_path, schedule_time, interval_seconds, is_recurring, next_run_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows
+    )
+    await conn.execute("DROP TABLE schedules")
+    await conn.execute("ALTER TABLE schedules_new RENAME TO schedules")
+    await conn.execute("CREATE INDEX idx_schedules_next_run ON schedules (is_recurring, next_run_at)")
+
+# Telegram file_ids of uploaded media, per session and file content
+async def create_media_cache_table(conn: aiosqlite.Connection):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            session TEXT NOT NULL,
+            file_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            PRIMARY KEY (session, file_hash)
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_media_cache_path ON media_cache (session, path)")
+
+# Registry of known session files; file_hash holds session_fingerprint(), not a content hash
+async def create_sessions_table(conn: aiosqlite.Connection):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            name TEXT PRIMARY KEY,
+            file_hash TEXT,
+            added_at INTEGER NOT NULL,
+            validated_at INTEGER,
+            status TEXT,
+            disabled BOOLEAN NOT NULL DEFAULT 0
+        )
+    """)
+
+# Resolved @username targets, and the numeric peer each schedule was created for
+async def create_peers_table(conn: aiosqlite.Connection):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS peers (
+            username TEXT PRIMARY KEY,
+            peer_id INTEGER NOT NULL,
+            peer_type TEXT NOT NULL,
+            resolved_at INTEGER NOT NULL
+        )
+    """)
+    await conn.execute("ALTER TABLE schedules ADD COLUMN peer_id INTEGER")
+
+# Delivery state of one-time schedules: pending -> in_flight -> deleted once sent, or failed
+async def create_outbox_columns(conn: aiosqlite.Connection):
+    await conn.execute("ALTER TABLE schedules ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'")
+    await conn.execute("ALTER TABLE schedules ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    await conn.execute("ALTER TABLE schedules ADD COLUMN last_error TEXT")
+    await conn.execute("ALTER TABLE schedules ADD COLUMN claimed_by TEXT")
+    await conn.execute("ALTER TABLE schedules ADD COLUMN idempotency_key INTEGER")
+    await conn.execute("UPDATE schedules SET idempotency_key = random() WHERE is_recurring = 0")
+    await conn.execute("DROP INDEX IF EXISTS idx_schedules_next_run")
+    await conn.execute("CREATE INDEX idx_schedules_due ON schedules (is_recurring, status, next_run_at)")
+
+# Compact delivery log keyed by integer name ids, with daily rollups for /stats. Incremental
+# auto_vacuum lets retention pruning give pages back; switching it on needs one full VACUUM
+async def create_delivery_history(conn: aiosqlite.Connection):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS history_names (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_history (
+            day INTEGER NOT NULL,
+            at INTEGER NOT NULL,
+            session_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            schedule_id INTEGER,
+            outcome INTEGER NOT NULL,
+            error_id INTEGER NOT NULL,
+            latency_ms INTEGER NOT NULL
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_delivery_history_day ON delivery_history (day)")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_rollups (
+            day INTEGER NOT NULL,
+            session_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            outcome INTEGER NOT NULL,
+            error_id INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            latency_ms_sum INTEGER NOT NULL,
+            PRIMARY KEY (day, session_id, chat_id, outcome, error_id)
+        ) WITHOUT ROWID
+    """)
+    await conn.commit()
+    await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    await conn.execute("VACUUM")
+
+# Applied in order; the database's user_version records how many have run
+MIGRATIONS = [
+    create_schedules_table,
+    migrate_epoch_schedule_times,
+    create_media_cache_table,
+    create_sessions_table,
+    create_peers_table,
+    create_outbox_columns,
+    create_delivery_history,
+]
+
+# Random 64-bit id sent as Telegram's random_id for every attempt at one delivery
+def new_idempotency_key() -> int:
+    return int.from_bytes(os.urandom(8), "big", signed=True)
+
+# Single shared connection to the schedules database
+class Database:
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[aiosqlite.Connection] = None
+        self.write_lock = asyncio.Lock()
+
+    # Open the connection, tune it for concurrent readers and run migrations
+    async def open(self):
+        # One long-lived connection keeps sqlite3's prepared statement cache warm
+        self.conn = await aiosqlite.connect(self.path, cached_statements=256)
+        await self.conn.execute("PRAGMA journal_mode=WAL")
+        await self.conn.execute("PRAGMA synchronous=NORMAL")
+        cursor = await self.conn.execute("PRAGMA user_version")
+        version = (await cursor.fetchone())[0]
+        for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            await migration(self.conn)
+            await self.conn.execute(f"PRAGMA user_version = {target}")
+            await self.conn.commit()
+            logger.info(f"Migrated database to version {target}")
+        logger.info("Database initialized")
+
+    async def close(self):
+        if self.conn:
+            await self.conn.close()
+            self.conn = None
+            logger.info("Database closed")
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        with metrics.timer("bot_db_query_seconds", op="read"):
+            cursor = await self.conn.execute(sql, params)
+            return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with metrics.timer("bot_db_query_seconds", op="read"):
+            cursor = await self.conn.execute(sql, params)
+            return await cursor.fetchall()
+
+    # All writes go through here so a batch of changes costs one commit
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.write_lock:
+            with metrics.timer("bot_db_query_seconds", op="write"):
+                try:
+                    yield self.conn
+                    await self.conn.commit()
+                except BaseException:
+                    await self.conn.rollback()
+                    raise
+
+db = Database(DB_PATH)
+
+# Rows per executemany transaction when importing schedules from the command line
+IMPORT_BATCH_SIZE = 1000
+EXPORT_COLUMNS = (
+    "chat_id", "text", "media_path", "schedule_time", "interval_seconds", "is_recurring", "next_run_at", "peer_id"
+)
+
+# Epoch seconds from an int or a "YYYY-MM-DD HH:MM[:SS]" string
+def parse_epoch(value) -> int:
+    if isinstance(value, int) or str(value).strip().isdigit():
+        return int(value)
+    for time_format in ("%Y-%m-%d %H:%M", TIME_FORMAT):
+        try:
+            return int(datetime.strptime(str(value).strip(), time_format).timestamp())
+        except ValueError:
+            pass
+    raise ValueError(f"invalid time {value!r}, use YYYY-MM-DD HH:MM or epoch seconds")
+
+# Validate one imported record and turn it into a schedules row
+def parse_schedule_record(record: dict, now: int) -> tuple:
+    chat_id = str(record.get("chat_id") or "").strip()
+    text = record.get("text")
+    if not chat_id:
+        raise ValueError("chat_id is required")
+    if not text:
+        raise ValueError("text is required")
+    media_path = record.get("media_path") or None
+    if media_path and not os.path.exists(media_path):
+        raise ValueError(f"media file not found: {media_path}")
+    is_recurring = str(record.get("is_recurring") or "").strip().lower() in ("1", "true", "yes")
+    peer_id = record.get("peer_id")
+    peer_id = int(peer_id) if peer_id not in (None, "") else None
+    next_run_at = record.get("next_run_at")
+    if is_recurring:
+        interval = int(record.get("interval_seconds") or 0)
+        if interval <= 0:
+            raise ValueError("recurring schedules need a positive interval_seconds")
+        schedule_time = None
+        next_run_at = parse_epoch(next_run_at) if next_run_at not in (None, "") else now + interval
+    else:
+        if record.get("schedule_time") in (None, ""):
+            raise ValueError("one-time schedules need a schedule_time")
+        interval = None
+        schedule_time = next_run_at = parse_epoch(record["schedule_time"])
+    idempotency_key = None if is_recurring else new_idempotency_key()
+    return (chat_id, text, media_path, schedule_time, interval, is_recurring, next_run_at, peer_id, idempotency_key)
+
+# Records from a CSV or JSONL file with the line they start on, read one at a time
+def read_records(f: io.TextIOBase, file_format: str):
+    if file_format == "csv":
+        reader = csv.DictReader(f)
+        # Reads the header row, so line_num points at it before the first record
+        header = reader.fieldnames
+        if not header:
+            raise ValueError("CSV file has no header row")
+        line_no = reader.line_num + 1
+        for record in reader:
+            yield line_no, record
+            line_no = reader.line_num + 1
+    else:
+        for line_no, line in enumerate(f, start=1):
+            if line.strip():
+                yield line_no, line
+
+async def import_schedules(database: Database, f: io.TextIOBase, file_format: str) -> Tuple[int, int]:
+    now = int(time.time())
+    imported, rejected = 0, 0
+    batch, batch_lines = [], []
+
+    async def flush():
+        nonlocal imported, rejected
+        try:
+            async with database.transaction() as conn:
+                await conn.executemany(
+                    """
+                    INSERT INTO schedules (
+                        chat_id, text, media_path, schedule_time, interval_seconds, is_recurring, next_run_at,
+                        peer_id, idempotency_key
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    batch
+                )
+            imported += len(batch)
+        except Exception as e:
+            rejected += len(batch)
+            print(f"lines {batch_lines[0]}-{batch_lines[-1]}: batch not imported: {e}", file=sys.stderr)
+        batch.clear()
+        batch_lines.clear()
+
+    for line_no, record in read_records(f, file_format):
+        try:
+            if isinstance(record, str):
+                record = json.loads(record)
+            batch.append(parse_schedule_record(record, now))
+            batch_lines.append(line_no)
+        except (ValueError, TypeError, AttributeError) as e:
+            rejected += 1
+            print(f"line {line_no}: {e}", file=sys.stderr)
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+    logger.info(f"Imported {imported} schedules, rejected {rejected}")
+    return imported, rejected
+
+async def export_schedules(database: Database, f: io.TextIOBase, file_format: str) -> int:
+    writer = csv.writer(f) if file_format == "csv" else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+    exported, last_id = 0, 0
+    while True:
+        rows = await database.fetchall(
+            f"SELECT id, {', '.join(EXPORT_COLUMNS)} FROM schedules WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, IMPORT_BATCH_SIZE)
+        )
+        for row in rows:
+            values = row[1:]
+            if writer:
+                writer.writerow(["" if v is None else v for v in values])
+            else:
+                record = dict(zip(EXPORT_COLUMNS, values))
+                record["is_recurring"] = bool(record["is_recurring"])
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        exported += len(rows)
+        if len(rows) < IMPORT_BATCH_SIZE:
+            break
+        last_id = rows[-1][0]
+    logger.info(f"Exported {exported} schedules")
+    return exported
+
+async def run_schedule_file_command(options: argparse.Namespace) -> int:
+    file_format = options.format or ("csv" if options.path.endswith(".csv") else "jsonl")
+    database = Database(options.db)
+    await database.open()
+    try:
+        if options.command == "import":
+            f = sys.stdin if options.path == "-" else open(options.path, newline="", encoding="utf-8")
+            with f:
+                try:
+                    imported, rejected = await import_schedules(database, f, file_format)
+                except ValueError as e:
+                    print(f"Error: {e}", file=sys.stderr)
+                    return 1
+            print(f"Imported {imported} schedules, rejected {rejected}", file=sys.stderr)
+            return 1 if rejected else 0
+        f = sys.stdout if options.path == "-" else open(options.path, "w", newline="", encoding="utf-8")
+        with f:
+            exported = await export_schedules(database, f, file_format)
+        print(f"Exported {exported} schedules", file=sys.stderr)
+        return 0
+    finally:
+        await database.close()
+
+# Offline import/export of schedules; a running bot only picks up imported rows after a restart
+def run_cli(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="bot.py", description="Import or export schedules without starting the bot")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in (("import", "add schedules from a file"), ("export", "write all schedules to a file")):
+        command_parser = commands.add_parser(command, help=help_text)
+        command_parser.add_argument("path", help='CSV or JSONL file, or "-" for stdin/stdout')
+        command_parser.add_argument("--format", choices=["csv", "jsonl"], help="default: from the file extension")
+        command_parser.add_argument("--db", default=DB_PATH, help=f"database path (default: {DB_PATH})")
+    options = parser.parse_args(argv)
+    return asyncio.run(run_schedule_file_command(options))
+
+# Handled before pyrogram is imported so the CLI starts quickly without a Telegram client
+if __name__ == "__main__" and len(sys.argv) > 1:
+    sys.exit(run_cli(sys.argv[1:]))
+
+from pyrogram import Client, filters, enums
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from pyrogram.errors import (
+    FloodWait,
+    RPCError,
+    FileIdInvalid,
+    FileReferenceExpired,
+    MediaEmpty,
+    PeerIdInvalid,
+    UsernameInvalid,
+    UsernameNotOccupied,
+    RandomIdDuplicate,
+    BadRequest,
+    Forbidden,
+    AuthKeyUnregistered,
+    SessionRevoked,
+    UserDeactivatedBan
+)
 
-# Initialize database
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS schedules (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id TEXT NOT NULL,
-                text TEXT NOT NULL,
-                media_path TEXT,
-                schedule_time TEXT,
-                interval_seconds INTEGER,
-                is_recurring BOOLEAN NOT NULL
+# Admin bot client
+bot = Client("bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+
+# Send errors that will fail the same way on retry
+PERMANENT_SEND_ERRORS = (BadRequest, Forbidden)
+
+# Errors that mean a session's authorization is gone for good
+AUTH_DEAD_ERRORS = (AuthKeyUnregistered, SessionRevoked, UserDeactivatedBan)
+
+# Last known state of one session
+class SessionHealth:
+    def __init__(self):
+        self.state = "connecting"
+        self.detail = ""
+        self.flood_until = 0.0
+        self.last_success: Optional[float] = None
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def current_state(self) -> str:
+        if self.state == "connected" and self.flood_until > time.time():
+            return "flood-cooling"
+        return self.state
+
+# Session states and schedule counts kept up to date in memory for /status
+class HealthTracker:
+    def __init__(self):
+        self.sessions: Dict[str, SessionHealth] = {}
+        self.one_time_schedules = 0
+        self.recurring_schedules = 0
+
+    def session(self, session_name: str) -> SessionHealth:
+        health = self.sessions.get(session_name)
+        if health is None:
+            health = self.sessions[session_name] = SessionHealth()
+        return health
+
+    def forget(self, session_name: str):
+        self.sessions.pop(session_name, None)
+
+    def mark_connected(self, session_name: str):
+        health = self.session(session_name)
+        health.state, health.detail = "connected", ""
+
+    def mark_parked(self, session_name: str):
+        health = self.session(session_name)
+        health.state, health.detail = "parked", ""
+
+    # Record a failed start or reconnect
+    def mark_failed(self, session_name: str, error: Exception):
+        health = self.session(session_name)
+        health.state = "auth-dead" if isinstance(error, AUTH_DEAD_ERRORS) else "disconnected"
+        health.detail = str(error)
+        health.errors[type(error).__name__] += 1
+
+    def mark_flood(self, session_name: str, seconds: int):
+        health = self.session(session_name)
+        health.flood_until = time.time() + seconds
+        health.errors["FloodWait"] += 1
+
+    def record_success(self, session_name: str):
+        self.session(session_name).last_success = time.time()
+
+    def record_error(self, session_name: str, error: Exception):
+        if isinstance(error, AUTH_DEAD_ERRORS):
+            self.mark_failed(session_name, error)
+        else:
+            self.session(session_name).errors[type(error).__name__] += 1
+
+    # Seed the schedule counters once; handlers keep them current afterwards
+    async def load_counts(self):
+        counts = dict(await db.fetchall("SELECT is_recurring, COUNT(*) FROM schedules GROUP BY is_recurring"))
+        self.one_time_schedules = counts.get(0, 0)
+        self.recurring_schedules = counts.get(1, 0)
+
+    def schedules_changed(self, is_recurring: bool, delta: int):
+        if is_recurring:
+            self.recurring_schedules += delta
+        else:
+            self.one_time_schedules += delta
+
+    def render_sessions(self) -> str:
+        if not self.sessions:
+            return "No sessions.\n"
+        now = time.time()
+        response = ""
+        for session_name, health in sorted(self.sessions.items()):
+            state = health.current_state()
+            if state == "flood-cooling":
+                state += f" ({int(health.flood_until - now)}s left)"
+            last_success = f"{int(now - health.last_success)}s ago" if health.last_success else "never"
+            errors = ", ".join(f"{name}={count}" for name, count in sorted(health.errors.items())) or "none"
+            response += f"{session_name}: {state}, last send {last_success}, errors: {errors}\n"
+            if health.detail:
+                response += f"  {health.detail}\n"
+        return response
+
+health = HealthTracker()
+
+# Session registry: the database, not SESSION_DIR, is the list of known sessions
+async def list_sessions(include_disabled: bool = False) -> List[str]:
+    if include_disabled:
+        rows = await db.fetchall("SELECT name FROM sessions ORDER BY name")
+    else:
+        rows = await db.fetchall("SELECT name FROM sessions WHERE disabled = 0 ORDER BY name")
+    return [name for (name,) in rows]
+
+async def register_session(session_name: str, file_hash: str, status: Optional[str] = None):
+    async with db.transaction() as conn:
+        await conn.execute(
+            """
+            INSERT INTO sessions (name, file_hash, added_at, validated_at, status, disabled)
+            VALUES (?, ?, ?, ?, ?, 0)
+            ON CONFLICT (name) DO UPDATE SET
+                file_hash = excluded.file_hash, validated_at = excluded.validated_at,
+                status = excluded.status, disabled = 0
+            """,
+            (session_name, file_hash, int(time.time()), int(time.time()) if status else None, status)
+        )
+
+async def record_session_status(session_name: str, status: str, disabled: bool = False):
+    async with db.transaction() as conn:
+        await conn.execute(
+            "UPDATE sessions SET validated_at = ?, status = ?, disabled = MAX(disabled, ?) WHERE name = ?",
+            (int(time.time()), status, disabled, session_name)
+        )
+
+async def unregister_session(session_name: str):
+    async with db.transaction() as conn:
+        await conn.execute("DELETE FROM sessions WHERE name = ?", (session_name,))
+
+# Pick up session files added, replaced or deleted outside the bot
+async def reconcile_sessions():
+    loop = asyncio.get_running_loop()
+    on_disk = {
+        os.path.splitext(f)[0]: os.path.join(SESSION_DIR, f)
+        for f in os.listdir(SESSION_DIR) if f.endswith(".session")
+    }
+    known = dict(await db.fetchall("SELECT name, file_hash FROM sessions"))
+    added, changed = [], []
+    for session_name, session_path in on_disk.items():
+        file_hash = await loop.run_in_executor(None, session_fingerprint, session_path)
+        if session_name not in known:
+            added.append((session_name, file_hash, int(time.time())))
+        elif known[session_name] != file_hash:
+            changed.append((file_hash, session_name))
+    removed = [(name,) for name in known if name not in on_disk]
+    if added or changed or removed:
+        async with db.transaction() as conn:
+            await conn.executemany(
+                "INSERT INTO sessions (name, file_hash, added_at, disabled) VALUES (?, ?, ?, 0)", added
             )
-        """)
-        await db.commit()
-    logger.info("Database initialized")
-
-# Load session clients
-async def load_session_clients(loop: asyncio.AbstractEventLoop) -> List[Client]:
-    clients = []
-    for session_file in os.listdir(SESSION_DIR):
-        if session_file.endswith(".session"):
-            session_name = os.path.splitext(session_file)[0]
-            client = Client(
-                name=os.path.join(SESSION_DIR, session_name),
-                api_id=API_ID,
-                api_hash=API_HASH,
-                workdir=SESSION_DIR,
-                loop=loop
+            await conn.executemany(
+                # A replaced file needs validating again, but stays disabled if an admin or a dead auth key disabled it
+                "UPDATE sessions SET file_hash = ?, validated_at = NULL, status = NULL WHERE name = ?",
+                changed
             )
+            await conn.executemany("DELETE FROM sessions WHERE name = ?", removed)
+    logger.info(
+        f"Reconciled sessions: {len(added)} added, {len(changed)} changed, {len(removed)} removed"
+    )
+
+# Close whatever a start() left open; a start that failed after connecting is connected but not initialized
+async def close_client(client: Client, session_name: str):
+    try:
+        if client.is_initialized:
+            await client.stop()
+        elif client.is_connected:
+            await client.disconnect()
+    except Exception as e:
+        logger.error(f"Error closing client for {session_name}: {e}")
+
+# Persistent pool of session clients shared by handlers and the scheduler
+class SessionPool:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.clients: Dict[str, Client] = {}
+        self.current_index = 0
+        self.connecting: Set[str] = set()
+        self.connect_limit = asyncio.Semaphore(MAX_CONCURRENT_CONNECTS)
+        # Set once a client is connected or every session has been tried
+        self.ready = asyncio.Event()
+        self.started = False
+        self.start_task: Optional[asyncio.Task] = None
+        self.filling = False
+        # Enabled sessions left disconnected to stay under MAX_CONNECTED_CLIENTS
+        self.parked: Set[str] = set()
+        self.activating: Set[str] = set()
+        self.last_used: Dict[str, float] = {}
+        self.in_use: Dict[str, int] = defaultdict(int)
+        # Held for every send on a client, so a pinned random_id never reaches another caller's send
+        self.send_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # Called whenever the set of connected clients changes
+        self.on_change: Optional[Callable[[], None]] = None
+
+    # pyrogram opens workdir/<name>.session, so the name is the bare session name
+    def build_client(self, session_name: str) -> Client:
+        return Client(
+            name=session_name,
+            api_id=API_ID,
+            api_hash=API_HASH,
+            workdir=SESSION_DIR
+        )
+
+    # Start every enabled session concurrently; meant to run in the background
+    async def start(self):
+        start = time.perf_counter()
+        try:
+            await reconcile_sessions()
+            session_names = await list_sessions()
+            for session_name in session_names[MAX_CONNECTED_CLIENTS:]:
+                self.park(session_name)
+            await asyncio.gather(*(self.add(name) for name in session_names[:MAX_CONNECTED_CLIENTS]))
+            # Give the slots of sessions that failed to connect to parked ones
+            while self.parked and len(self.clients) < MAX_CONNECTED_CLIENTS:
+                await self.add(self.parked.pop())
+            logger.info(
+                f"Session pool started with {len(self.clients)}/{len(session_names)} clients "
+                f"({len(self.parked)} parked) in {time.perf_counter() - start:.1f}s"
+            )
+        except Exception as e:
+            logger.error(f"Error starting session pool: {e}")
+        finally:
+            # Waiters must not hang on a pool that failed to start
+            self.started = True
+            self.ready.set()
+            self.changed()
+
+    # Wait until sessions can be borrowed, without waiting for the whole pool
+    async def wait_ready(self, timeout: float = SESSION_CONNECT_TIMEOUT) -> bool:
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return bool(self.clients)
+
+    def changed(self):
+        if self.on_change:
+            self.on_change()
+
+    # Start a single session and keep it in the pool
+    async def add(self, session_name: str) -> bool:
+        if session_name in self.clients:
+            return True
+        if session_name in self.connecting:
+            return False
+        self.parked.discard(session_name)
+        self.connecting.add(session_name)
+        try:
+            async with self.connect_limit:
+                client = self.build_client(session_name)
+                try:
+                    await asyncio.wait_for(client.start(), SESSION_CONNECT_TIMEOUT)
+                except Exception as e:
+                    if isinstance(e, asyncio.TimeoutError):
+                        e = TimeoutError(f"Connect timed out after {SESSION_CONNECT_TIMEOUT} seconds")
+                    await close_client(client, session_name)
+                    health.mark_failed(session_name, e)
+                    logger.error(f"Failed to load session {session_name}: {e}")
+                    if isinstance(e, AUTH_DEAD_ERRORS):
+                        await record_session_status(session_name, str(e), disabled=True)
+                    return False
+            self.clients[session_name] = client
+            self.last_used[session_name] = time.monotonic()
+            health.mark_connected(session_name)
+            logger.info(f"Loaded session: {session_name}")
+            self.changed()
+            self.ready.set()
+            return True
+        finally:
+            self.connecting.discard(session_name)
+
+    def park(self, session_name: str):
+        self.parked.add(session_name)
+        health.mark_parked(session_name)
+
+    # Connect a session, first stopping the least recently used idle one if the pool is full
+    async def activate(self, session_name: str) -> bool:
+        if session_name in self.clients:
+            return True
+        if session_name not in self.parked:
+            # Unknown, or another activate() already has it
+            return False
+        self.parked.discard(session_name)
+        self.activating.add(session_name)
+        try:
+            if len(self.clients) + len(self.connecting) >= MAX_CONNECTED_CLIENTS:
+                idle = [name for name in self.clients if not self.in_use[name]]
+                if not idle:
+                    self.park(session_name)
+                    return False
+                await self.evict(min(idle, key=lambda name: self.last_used.get(name, 0)), "lru")
+            start = time.perf_counter()
+            if not await self.add(session_name):
+                return False
+        finally:
+            self.activating.discard(session_name)
+        metrics.observe("bot_session_reconnect_seconds", time.perf_counter() - start, reason="activate")
+        return True
+
+    # Disconnect a session but keep it available for activate()
+    async def evict(self, session_name: str, reason: str):
+        client = self.clients.pop(session_name, None)
+        if not client:
+            return
+        self.park(session_name)
+        self.changed()
+        metrics.inc("bot_session_evictions_total", reason=reason)
+        try:
+            await client.stop()
+            logger.info(f"Parked session {session_name} ({reason})")
+        except Exception as e:
+            logger.error(f"Error stopping session {session_name}: {e}")
+
+    def has_free_slot(self) -> bool:
+        return len(self.clients) + len(self.connecting) + len(self.activating) < MAX_CONNECTED_CLIENTS
+
+    # Parked session that has waited longest for a turn, skipping any still sitting out a flood wait
+    def next_parked(self) -> Optional[str]:
+        now = time.time()
+        ready = [name for name in self.parked if health.session(name).flood_until <= now]
+        return min(ready, key=lambda name: self.last_used.get(name, 0), default=None)
+
+    # Called when work is queued: connect parked sessions into free slots so they take turns sending
+    def fill_on_demand(self):
+        if self.started and self.parked and not self.filling and self.has_free_slot():
+            self.filling = True
+            asyncio.create_task(self.fill_free_slots())
+
+    async def fill_free_slots(self):
+        try:
+            while self.has_free_slot():
+                session_name = self.next_parked()
+                if session_name is None or not await self.activate(session_name):
+                    break
+        finally:
+            self.filling = False
+
+    # Park connected sessions unused for SESSION_IDLE_SECONDS, least recently used first; one
+    # stays connected so commands don't wait on a reconnect
+    async def run_idle_eviction(self):
+        while True:
+            await asyncio.sleep(SESSION_IDLE_CHECK_SECONDS)
+            try:
+                cutoff = time.monotonic() - SESSION_IDLE_SECONDS
+                idle = sorted(
+                    (name for name in self.clients if not self.in_use[name] and self.last_used.get(name, 0) < cutoff),
+                    key=lambda name: self.last_used.get(name, 0)
+                )
+                for session_name in idle:
+                    if len(self.clients) <= 1:
+                        break
+                    await self.evict(session_name, "idle")
+            except Exception as e:
+                logger.error(f"Error parking idle sessions: {e}")
+
+    # A flooded session sits out the wait parked, and the warmest parked session takes its slot
+    async def replace_flooded(self, session_name: str):
+        if not self.parked:
+            return
+        replacement = max(self.parked, key=lambda name: self.last_used.get(name, 0))
+        await self.evict(session_name, "flood")
+        await self.activate(replacement)
+
+    # Borrow a connected client for one send; a leased client is never evicted
+    @asynccontextmanager
+    async def lease(self, session_name: str):
+        self.in_use[session_name] += 1
+        self.last_used[session_name] = time.monotonic()
+        try:
+            client = self.clients.get(session_name)
+            if client and await self.ensure_connected(session_name, client):
+                yield client
+            else:
+                yield None
+        finally:
+            self.in_use[session_name] -= 1
+
+    # Stop a session and drop it from the pool
+    async def remove(self, session_name: str):
+        client = self.clients.pop(session_name, None)
+        self.parked.discard(session_name)
+        self.last_used.pop(session_name, None)
+        self.in_use.pop(session_name, None)
+        self.send_locks.pop(session_name, None)
+        health.forget(session_name)
+        self.changed()
+        if client:
             try:
-                await client.start()
-                clients.append(client)
-                logger.info(f"Loaded session: {session_name}")
+                await client.stop()
+                logger.info(f"Stopped session: {session_name}")
             except Exception as e:
-                logger.error(f"Failed to load session {session_name}: {e}")
-    return clients
-
-# Rotate clients for load balancing
-current_client_index = 0
-async def get_next_client(clients: List[Client]) -> Optional[Client]:
-    global current_client_index
-    if not clients:
+                logger.error(f"Error stopping session {session_name}: {e}")
+
+    # Restart a client whose connection dropped
+    async def ensure_connected(self, session_name: str, client: Client) -> bool:
+        if client.is_connected:
+            return True
+        logger.warning(f"Session {session_name} disconnected, reconnecting")
+        start = time.perf_counter()
+        try:
+            await close_client(client, session_name)
+            await asyncio.wait_for(client.start(), SESSION_CONNECT_TIMEOUT)
+            metrics.observe("bot_session_reconnect_seconds", time.perf_counter() - start, reason="dropped")
+            health.mark_connected(session_name)
+            logger.info(f"Reconnected session: {session_name}")
+            return True
+        except Exception as e:
+            await close_client(client, session_name)
+            health.mark_failed(session_name, e)
+            logger.error(f"Failed to reconnect session {session_name}: {e}")
+            return False
+
+    # Rotate sessions for load balancing
+    async def next_session(self) -> Optional[str]:
+        await self.wait_ready()
+        for _ in range(len(self.clients)):
+            names = list(self.clients)
+            if not names:
+                return None
+            self.current_index = (self.current_index + 1) % len(names)
+            session_name = names[self.current_index]
+            if await self.ensure_connected(session_name, self.clients[session_name]):
+                return session_name
         return None
-    current_client_index = (current_client_index + 1) % len(clients)
-    return clients[current_client_index]
 
-# Send message using a session client
+    # Lease the next session in rotation for an ad-hoc command, holding its send lock
+    @asynccontextmanager
+    async def borrow(self):
+        session_name = await self.next_session()
+        if session_name is None:
+            yield None
+            return
+        async with self.lease(session_name) as client, self.send_locks[session_name]:
+            yield client
+
+    # Stop every client in the pool
+    async def stop(self):
+        if self.start_task and not self.start_task.done():
+            self.start_task.cancel()
+            await asyncio.gather(self.start_task, return_exceptions=True)
+        for session_name in list(self.clients):
+            await self.remove(session_name)
+
+# Hash a media file in chunks; run in an executor to keep disk reads off the loop
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Identity of a session file: the account and auth key stored in it. pyrogram rewrites the
+# file on every stop, so its content hash changes while this only changes when the file is replaced
+def session_fingerprint(path: str) -> str:
+    try:
+        conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        try:
+            row = conn.execute("SELECT dc_id, user_id, auth_key FROM sessions").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        row = None
+    if not row or row[2] is None:
+        # Not a readable pyrogram session; fall back to its content
+        return hash_file(path)
+    digest = hashlib.sha256(f"{row[0]}:{row[1]}:".encode())
+    digest.update(row[2])
+    return digest.hexdigest()
+
+# Look up the file_id a session got the last time it uploaded this file
+async def get_cached_file_id(session_name: str, media_path: str) -> Tuple[Optional[str], str]:
+    stat = os.stat(media_path)
+    row = await db.fetchone(
+        "SELECT file_hash, file_id, size, mtime FROM media_cache WHERE session = ? AND path = ?",
+        (session_name, media_path)
+    )
+    if row and row[2] == stat.st_size and row[3] == stat.st_mtime_ns:
+        return row[1], row[0]
+    file_hash = await asyncio.get_running_loop().run_in_executor(None, hash_file, media_path)
+    if row and row[0] != file_hash:
+        # The file's content changed since its file_id was cached
+        await invalidate_file_id(session_name, row[0])
+    row = await db.fetchone(
+        "SELECT file_id FROM media_cache WHERE session = ? AND file_hash = ?", (session_name, file_hash)
+    )
+    if not row:
+        return None, file_hash
+    # Same content under a new path or mtime
+    async with db.transaction() as conn:
+        await conn.execute(
+            "UPDATE media_cache SET path = ?, size = ?, mtime = ? WHERE session = ? AND file_hash = ?",
+            (media_path, stat.st_size, stat.st_mtime_ns, session_name, file_hash)
+        )
+    return row[0], file_hash
+
+async def store_file_id(session_name: str, media_path: str, file_hash: str, file_id: str):
+    stat = os.stat(media_path)
+    async with db.transaction() as conn:
+        await conn.execute(
+            """
+            INSERT OR REPLACE INTO media_cache (session, file_hash, file_id, path, size, mtime)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (session_name, file_hash, file_id, media_path, stat.st_size, stat.st_mtime_ns)
+        )
+
+async def invalidate_file_id(session_name: str, file_hash: str):
+    async with db.transaction() as conn:
+        await conn.execute(
+            "DELETE FROM media_cache WHERE session = ? AND file_hash = ?", (session_name, file_hash)
+        )
+
+# Targets that mean each sending session's own account, so they have no shared peer id
+SELF_CHATS = {"me", "self"}
+
+def is_self_chat(chat_id) -> bool:
+    return str(chat_id).lstrip("@").lower() in SELF_CHATS
+
+# Cache key for a chat target, or None when it is a numeric id or the sending account itself
+def username_of(chat_id) -> Optional[str]:
+    if isinstance(chat_id, int) or str(chat_id).lstrip("-").isdigit() or is_self_chat(chat_id):
+        return None
+    return str(chat_id).lstrip("@").lower()
+
+# Numeric peer id for a chat target, or None for the sending account itself;
+# usernames are resolved once per TTL by the bot and cached
+async def resolve_peer_id(chat_id) -> Optional[int]:
+    if is_self_chat(chat_id):
+        return None
+    username = username_of(chat_id)
+    if username is None:
+        return int(chat_id)
+    row = await db.fetchone("SELECT peer_id, resolved_at FROM peers WHERE username = ?", (username,))
+    if row and time.time() - row[1] < PEER_CACHE_TTL:
+        metrics.inc("bot_peer_cache_total", result="hit")
+        return row[0]
+    metrics.inc("bot_peer_cache_total", result="miss")
+    chat = await bot.get_chat(username)
+    async with db.transaction() as conn:
+        await conn.execute(
+            "INSERT OR REPLACE INTO peers (username, peer_id, peer_type, resolved_at) VALUES (?, ?, ?, ?)",
+            (username, chat.id, str(getattr(chat.type, "value", chat.type)), int(time.time()))
+        )
+    logger.info(f"Resolved @{username} to {chat.id}")
+    return chat.id
+
+# Forget a username whose peer no longer matches, including ids stored on schedules
+async def invalidate_peer(chat_id):
+    username = username_of(chat_id)
+    if username is None:
+        return
+    async with db.transaction() as conn:
+        await conn.execute("DELETE FROM peers WHERE username = ?", (username,))
+        await conn.execute("UPDATE schedules SET peer_id = NULL WHERE chat_id = ?", (chat_id,))
+    logger.warning(f"Invalidated cached peer for @{username}")
+
+# Split an optional trailing media=<file> argument off command text
+def split_media_arg(text: str) -> Tuple[str, Optional[str]]:
+    words = text.rsplit(maxsplit=1)
+    if not words or not words[-1].startswith(MEDIA_ARG):
+        return text, None
+    return (words[0] if len(words) == 2 else ""), words[-1][len(MEDIA_ARG):]
+
+# Path of an existing file inside MEDIA_DIR, or None when it is missing or escapes the directory
+def media_dir_file(name: str) -> Optional[str]:
+    root = os.path.realpath(MEDIA_DIR)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        return None
+    return path
+
+# Media kind pyrogram uses for a file extension
+def media_kind(media_path: str) -> str:
+    ext = os.path.splitext(media_path)[1].lower()
+    if ext in [".jpg", ".png", ".jpeg"]:
+        return "photo"
+    elif ext in [".mp4", ".avi", ".mkv"]:
+        return "video"
+    return "document"
+
+# Send a photo, video or document by local path or by file_id
+async def send_media_file(client: Client, kind: str, chat_id: str, media: str, text: str):
+    if kind == "photo":
+        return await client.send_photo(chat_id, media, caption=text)
+    elif kind == "video":
+        return await client.send_video(chat_id, media, caption=text)
+    return await client.send_document(chat_id, media, caption=text)
+
+# Send message using a session client; FloodWait and RPCError are left to the caller
 async def send_message_with_session(
-    clients: List[Client], chat_id: str, text: str, media_path: Optional[str] = None
-) -> bool:
-    client = await get_next_client(clients)
-    if not client:
-        logger.error("No active session clients available")
-        return False
+    session_name: str, client: Client, chat_id: str, text: str, media_path: Optional[str] = None
+):
+    with metrics.timer("bot_send_seconds", media=media_kind(media_path) if media_path else "text"):
+        await deliver_message(session_name, client, chat_id, text, media_path)
+    logger.info(
+        f"Message sent to {chat_id}", extra={"session": session_name, "chat": chat_id, "sampled": True}
+    )
+
+async def deliver_message(
+    session_name: str, client: Client, chat_id: str, text: str, media_path: Optional[str] = None
+):
+    if media_path:
+        kind = media_kind(media_path)
+        file_id, file_hash = await get_cached_file_id(session_name, media_path)
+        sent = None
+        if file_id:
+            try:
+                sent = await send_media_file(client, kind, chat_id, file_id, text)
+            except (FileIdInvalid, FileReferenceExpired, MediaEmpty) as e:
+                logger.warning(f"Cached file_id for {media_path} rejected, uploading again: {e}")
+                await invalidate_file_id(session_name, file_hash)
+        if not sent:
+            sent = await send_media_file(client, kind, chat_id, media_path, text)
+            uploaded = getattr(sent, kind, None)
+            if uploaded:
+                await store_file_id(session_name, media_path, file_hash, uploaded.file_id)
+    else:
+        await client.send_message(chat_id, text)
+
+# Seconds a FloodWait asks for (.x on pyrogram 1.x, .value on 2.x)
+def flood_wait_seconds(e: FloodWait) -> int:
+    return int(getattr(e, "value", None) or getattr(e, "x", 0))
+
+# Pin the random_id pyrogram attaches to a send, so Telegram rejects a second copy of a
+# delivery that already went through on this account with RandomIdDuplicate; the caller
+# holds the session's send lock so no other send on the client picks the pinned id up
+@contextmanager
+def fixed_random_id(client: Client, random_id: Optional[int]):
+    if random_id is None:
+        yield
+        return
+    original = client.__dict__.get("rnd_id")
+    client.rnd_id = lambda: random_id
     try:
-        if media_path:
-            ext = os.path.splitext(media_path)[1].lower()
-            if ext in [".jpg", ".png", ".jpeg"]:
-                await client.send_photo(chat_id, media_path, caption=text)
-            elif ext in [".mp4", ".avi", ".mkv"]:
-                await client.send_video(chat_id, media_path, caption=text)
-            else:
-                await client.send_document(chat_id, media_path, caption=text)
+        yield
+    finally:
+        if original is None:
+            del client.rnd_id
         else:
-            await client.send_message(chat_id, text)
-        logger.info(f"Message sent to {chat_id}")
-        return True
-    except FloodWait as e:
-        logger.warning(f"Flood wait: {e.x} seconds")
-        await asyncio.sleep(e.x)
-        return False
-    except RPCError as e:
-        logger.error(f"Error sending message to {chat_id}: {e}")
-        return False
-
-# Validate a session file
-async def validate_session(session_path: str, session_name: str, loop: asyncio.AbstractEventLoop) -> Tuple[bool, str]:
+            client.rnd_id = original
+
+# Delay before the next attempt at a failed delivery
+def outbox_backoff(attempts: int) -> float:
+    delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+    return random.uniform(delay / 2, delay)
+
+# Outcomes stored in delivery_history and delivery_rollups
+OUTCOME_SENT, OUTCOME_ERROR, OUTCOME_CANCELLED = 0, 1, 2
+
+# Buffered delivery log; each flush writes raw rows and bumps the daily rollups in one transaction
+class DeliveryHistory:
+    def __init__(self):
+        self.pending: List[tuple] = []
+        self.name_ids: Dict[str, int] = {}
+
+    def record(
+        self,
+        session_name: Optional[str],
+        chat_id,
+        schedule_id: Optional[int],
+        outcome: int,
+        error: Optional[str] = None,
+        latency: float = 0.0
+    ):
+        self.pending.append(
+            (int(time.time()), session_name or "", str(chat_id), schedule_id, outcome, error or "", int(latency * 1000))
+        )
+
+    # Integer id for a session, chat or error name; 0 stands for none
+    async def name_id(self, conn: aiosqlite.Connection, name: str, new_ids: Dict[str, int]) -> int:
+        if not name:
+            return 0
+        name_id = self.name_ids.get(name) or new_ids.get(name)
+        if name_id is None:
+            await conn.execute("INSERT OR IGNORE INTO history_names (name) VALUES (?)", (name,))
+            cursor = await conn.execute("SELECT id FROM history_names WHERE name = ?", (name,))
+            name_id = new_ids[name] = (await cursor.fetchone())[0]
+        return name_id
+
+    async def flush(self):
+        if not self.pending:
+            return
+        records, self.pending = self.pending, []
+        try:
+            await self.write(records)
+        except BaseException:
+            # Rolled back: keep the records, ahead of any recorded since, for the next flush
+            self.pending[:0] = records
+            raise
+
+    async def write(self, records: List[tuple]):
+        rows = []
+        rollups: Dict[tuple, List[int]] = defaultdict(lambda: [0, 0])
+        new_ids: Dict[str, int] = {}
+        async with db.transaction() as conn:
+            for at, session_name, chat, schedule_id, outcome, error, latency_ms in records:
+                session_id = await self.name_id(conn, session_name, new_ids)
+                chat_id = await self.name_id(conn, chat, new_ids)
+                error_id = await self.name_id(conn, error, new_ids)
+                day = at // 86400
+                rows.append((day, at, session_id, chat_id, schedule_id, outcome, error_id, latency_ms))
+                rollup = rollups[(day, session_id, chat_id, outcome, error_id)]
+                rollup[0] += 1
+                rollup[1] += latency_ms
+            await conn.executemany(
+                """
+                INSERT INTO delivery_history
+                    (day, at, session_id, chat_id, schedule_id, outcome, error_id, latency_ms)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows
+            )
+            await conn.executemany(
+                """
+                INSERT INTO delivery_rollups (day, session_id, chat_id, outcome, error_id, count, latency_ms_sum)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (day, session_id, chat_id, outcome, error_id) DO UPDATE SET
+                    count = count + excluded.count, latency_ms_sum = latency_ms_sum + excluded.latency_ms_sum
+                """,
+                [key + tuple(values) for key, values in rollups.items()]
+            )
+        # Only ids that were committed are safe to reuse
+        self.name_ids.update(new_ids)
+
+    # Drop whole days past retention and hand the freed pages back to the filesystem
+    async def prune(self):
+        today = int(time.time() // 86400)
+        async with db.transaction() as conn:
+            cursor = await conn.execute(
+                "DELETE FROM delivery_history WHERE day < ?", (today - HISTORY_RETENTION_DAYS + 1,)
+            )
+            history_rows = cursor.rowcount
+            cursor = await conn.execute(
+                "DELETE FROM delivery_rollups WHERE day < ?", (today - ROLLUP_RETENTION_DAYS + 1,)
+            )
+            rollup_rows = cursor.rowcount
+        async with db.transaction() as conn:
+            # Each step of the pragma frees one page, so it has to be read to the end
+            cursor = await conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+            await cursor.fetchall()
+        if history_rows or rollup_rows:
+            logger.info(f"Pruned {history_rows} delivery history rows and {rollup_rows} rollup rows")
+
+    async def run(self):
+        last_prune = 0.0
+        while True:
+            await asyncio.sleep(HISTORY_FLUSH_SECONDS)
+            try:
+                await self.flush()
+                if time.time() - last_prune >= HISTORY_PRUNE_INTERVAL_SECONDS:
+                    last_prune = time.time()
+                    await self.prune()
+            except Exception as e:
+                logger.error(f"Error writing delivery history: {e}")
+
+    # Per-session and per-chat summary for /stats, read from the rollups only
+    async def render_stats(self, days: int) -> str:
+        since = int(time.time() // 86400) - days + 1
+        totals = {
+            outcome: (count, latency_ms_sum) for outcome, count, latency_ms_sum in await db.fetchall(
+                """
+                SELECT outcome, SUM(count), SUM(latency_ms_sum) FROM delivery_rollups
+                WHERE day >= ? GROUP BY outcome
+                """,
+                (since,)
+            )
+        }
+        sent, latency_ms_sum = totals.get(OUTCOME_SENT, (0, 0))
+        errors = totals.get(OUTCOME_ERROR, (0, 0))[0]
+        cancelled = totals.get(OUTCOME_CANCELLED, (0, 0))[0]
+        response = (
+            f"Delivery stats, last {days} days:\n"
+            f"Sent: {sent}, Errors: {errors} ({errors / max(sent + errors, 1):.1%}), Cancelled: {cancelled}\n"
+            f"Average send latency: {latency_ms_sum / max(sent, 1):.0f} ms\n"
+        )
+        for title, column in (("By session", "session_id"), ("By chat", "chat_id")):
+            rows = await db.fetchall(
+                f"""
+                SELECT n.name,
+                    SUM(CASE WHEN r.outcome = {OUTCOME_SENT} THEN r.count ELSE 0 END) AS sent,
+                    SUM(CASE WHEN r.outcome = {OUTCOME_ERROR} THEN r.count ELSE 0 END) AS errors,
+                    SUM(CASE WHEN r.outcome = {OUTCOME_SENT} THEN r.latency_ms_sum ELSE 0 END)
+                FROM delivery_rollups r JOIN history_names n ON n.id = r.{column}
+                WHERE r.day >= ? AND r.outcome != {OUTCOME_CANCELLED}
+                GROUP BY r.{column} ORDER BY sent + errors DESC LIMIT ?
+                """,
+                (since, STATS_TOP_N)
+            )
+            response += f"\n{title}:\n"
+            for name, name_sent, name_errors, name_latency in rows:
+                response += (
+                    f"{name}: {name_sent} sent, {name_errors} errors "
+                    f"({name_errors / max(name_sent + name_errors, 1):.1%}), "
+                    f"avg {name_latency / max(name_sent, 1):.0f} ms\n"
+                )
+        rows = await db.fetchall(
+            f"""
+            SELECT n.name, SUM(r.count) FROM delivery_rollups r JOIN history_names n ON n.id = r.error_id
+            WHERE r.day >= ? AND r.outcome = {OUTCOME_ERROR}
+            GROUP BY r.error_id ORDER BY 2 DESC LIMIT ?
+            """,
+            (since, STATS_TOP_N)
+        )
+        if rows:
+            response += "\nTop errors:\n" + "".join(f"{name}: {count}\n" for name, count in rows)
+        return response
+
+history = DeliveryHistory()
+
+# A message waiting for a session worker
+class DeliveryJob:
+    def __init__(
+        self,
+        chat_id: str,
+        text: str,
+        media_path: Optional[str] = None,
+        schedule_id: Optional[int] = None,
+        due_at: Optional[float] = None,
+        peer_id: Optional[int] = None,
+        attempts: int = 0,
+        idempotency_key: Optional[int] = None,
+        session: Optional[str] = None
+    ):
+        self.chat_id = chat_id
+        self.text = text
+        self.media_path = media_path
+        self.schedule_id = schedule_id
+        self.due_at = due_at
+        self.peer_id = peer_id
+        self.attempts = attempts
+        self.idempotency_key = idempotency_key
+        # Session that must retry this job, because it may already have sent it
+        self.session = session
+        # Set when the caller stops waiting; workers drop the job instead of sending it
+        self.cancelled = False
+        self.error: Optional[BaseException] = None
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def finish(self, sent: bool, error: Optional[BaseException] = None):
+        if not self.result.done():
+            self.error = error
+            self.result.set_result(sent)
+
+# Delivers queued messages with one worker per session
+class Dispatcher:
+    def __init__(self, pool: SessionPool):
+        self.pool = pool
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.workers: Dict[str, asyncio.Task] = {}
+        self.send_limit = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+        self.queued_schedules: Dict[int, DeliveryJob] = {}
+        # Recovered jobs waiting for the session that was sending them
+        self.session_jobs: Dict[str, List[DeliveryJob]] = defaultdict(list)
+        self.claims: List[Tuple[str, int]] = []
+        self.claim_commit: Optional[asyncio.Task] = None
+        self.finished_jobs: List[DeliveryJob] = []
+        self.flush_pending = False
+
+    # Start workers for new sessions and stop those of removed ones
+    def sync_workers(self):
+        for session_name in self.pool.clients:
+            if session_name not in self.workers:
+                self.workers[session_name] = asyncio.create_task(self.worker(session_name))
+        for session_name in list(self.workers):
+            if session_name not in self.pool.clients:
+                self.workers.pop(session_name).cancel()
+        # Sessions that are gone hand their recovered jobs to everyone else
+        if self.pool.started:
+            for session_name in list(self.session_jobs):
+                if session_name in self.pool.parked:
+                    asyncio.create_task(self.pool.activate(session_name))
+                elif session_name not in self.pool.clients.keys() | self.pool.connecting | self.pool.activating:
+                    for job in self.session_jobs.pop(session_name):
+                        job.session = None
+                        self.queue.put_nowait(job)
+
+    def submit(self, job: DeliveryJob):
+        if job.schedule_id is not None:
+            self.queued_schedules[job.schedule_id] = job
+            job.result.add_done_callback(lambda _: self.schedule_done(job))
+        self.enqueue(job)
+
+    # A job pinned to a session waits for that session; any other goes on the shared queue
+    def enqueue(self, job: DeliveryJob):
+        if job.session:
+            self.session_jobs[job.session].append(job)
+            if job.session in self.pool.parked:
+                asyncio.create_task(self.pool.activate(job.session))
+        else:
+            self.queue.put_nowait(job)
+            self.pool.fill_on_demand()
+
+    # Requeue deliveries a previous run left in flight, on the session that was sending them
+    async def recover(self):
+        rows = await db.fetchall(
+            """
+            SELECT id, chat_id, text, media_path, next_run_at, peer_id, attempts, idempotency_key, claimed_by
+            FROM schedules WHERE is_recurring = 0 AND status = 'in_flight'
+            """
+        )
+        for schedule_id, chat_id, text, media_path, next_run_at, peer_id, attempts, key, claimed_by in rows:
+            self.submit(DeliveryJob(chat_id, text, media_path, schedule_id, next_run_at, peer_id, attempts, key, claimed_by))
+        if rows:
+            logger.info(f"Recovered {len(rows)} deliveries left in flight")
+
+    # Queue a message and wait until a worker has tried to deliver it
+    async def send(
+        self,
+        chat_id: str,
+        text: str,
+        media_path: Optional[str] = None,
+        due_at: Optional[float] = None,
+        peer_id: Optional[int] = None
+    ) -> bool:
+        if not self.workers:
+            await self.pool.wait_ready()
+        if not self.workers:
+            logger.error("No active session clients available")
+            return False
+        if peer_id is None:
+            try:
+                peer_id = await resolve_peer_id(chat_id)
+            except RPCError as e:
+                # Leave it to the sending session to resolve the username itself
+                logger.warning(f"Could not resolve {chat_id}: {e}")
+        job = DeliveryJob(chat_id, text, media_path, due_at=due_at, peer_id=peer_id)
+        self.submit(job)
+        try:
+            return await job.result
+        except asyncio.CancelledError:
+            # Still queued, it is dropped; one a worker is already sending can't be recalled
+            job.cancelled = True
+            raise
+
+    # Drop the queued delivery of a cancelled schedule; one already sending can't be recalled
+    def cancel_schedule(self, schedule_id: int):
+        job = self.queued_schedules.get(schedule_id)
+        if job:
+            job.cancelled = True
+
+    # Return an unsent job; a pinned one stays with its session, which may already have sent it
+    def requeue(self, job: DeliveryJob):
+        self.enqueue(job)
+        if job.session and job.session not in self.pool.clients and job.session not in self.pool.parked:
+            # Its session left the pool after the last sync, so apply the gone-session rule now
+            self.sync_workers()
+
+    async def worker(self, session_name: str):
+        while True:
+            backlog = self.session_jobs.get(session_name)
+            from_queue = not backlog
+            job = await self.queue.get() if from_queue else backlog.pop(0)
+            try:
+                if job.cancelled:
+                    logger.info(f"Dropped cancelled delivery to {job.chat_id}")
+                    job.finish(False)
+                    continue
+                async with self.pool.lease(session_name) as client:
+                    if not client:
+                        self.requeue(job)
+                        await asyncio.sleep(SCHEDULE_RETRY_SECONDS)
+                        continue
+                    if job.schedule_id is not None:
+                        await self.claim(session_name, job)
+                    async with self.send_limit, self.pool.send_locks[session_name]:
+                        started = time.perf_counter()
+                        with fixed_random_id(client, job.idempotency_key):
+                            await self.deliver(session_name, client, job)
+                        elapsed = time.perf_counter() - started
+                history.record(session_name, job.chat_id, job.schedule_id, OUTCOME_SENT, latency=elapsed)
+                metrics.inc("bot_send_success_total")
+                health.record_success(session_name)
+                if job.due_at is not None:
+                    metrics.observe("bot_scheduler_lag_seconds", max(time.time() - job.due_at, 0))
+                job.finish(True)
+            except RandomIdDuplicate:
+                logger.info(
+                    f"Schedule {job.schedule_id} was already delivered by {session_name}",
+                    extra={"session": session_name, "chat": job.chat_id, "schedule_id": job.schedule_id}
+                )
+                history.record(session_name, job.chat_id, job.schedule_id, OUTCOME_SENT)
+                job.finish(True)
+            except FloodWait as e:
+                # Park this account only; another worker picks the job up
+                wait = flood_wait_seconds(e)
+                history.record(session_name, job.chat_id, job.schedule_id, OUTCOME_ERROR, type(e).__name__)
+                metrics.inc("bot_send_errors_total", error=type(e).__name__)
+                metrics.inc("bot_flood_wait_seconds_total", wait, session=session_name)
+                health.mark_flood(session_name, wait)
+                logger.warning(
+                    f"Session {session_name} flood wait: {wait} seconds",
+                    extra={"session": session_name, "chat": job.chat_id, "schedule_id": job.schedule_id}
+                )
+                self.requeue(job)
+                if wait > FLOOD_EVICT_SECONDS and self.pool.parked:
+                    # Runs apart from this worker, which eviction cancels
+                    asyncio.create_task(self.pool.replace_flooded(session_name))
+                await asyncio.sleep(wait)
+            except RPCError as e:
+                history.record(session_name, job.chat_id, job.schedule_id, OUTCOME_ERROR, type(e).__name__)
+                metrics.inc("bot_send_errors_total", error=type(e).__name__)
+                health.record_error(session_name, e)
+                if isinstance(e, (PeerIdInvalid, UsernameInvalid, UsernameNotOccupied)):
+                    await invalidate_peer(job.chat_id)
+                logger.error(
+                    f"Error sending message to {job.chat_id}: {e}",
+                    extra={"session": session_name, "chat": job.chat_id, "schedule_id": job.schedule_id}
+                )
+                job.finish(False, e)
+            except asyncio.CancelledError:
+                self.requeue(job)
+                raise
+            except Exception as e:
+                history.record(session_name, job.chat_id, job.schedule_id, OUTCOME_ERROR, type(e).__name__)
+                metrics.inc("bot_send_errors_total", error=type(e).__name__)
+                health.record_error(session_name, e)
+                logger.error(
+                    f"Session {session_name} failed to send to {job.chat_id}: {e}",
+                    extra={"session": session_name, "chat": job.chat_id, "schedule_id": job.schedule_id}
+                )
+                job.finish(False, e)
+            finally:
+                if from_queue:
+                    self.queue.task_done()
+
+    # Mark a schedule in flight on this session before sending it; claims made by workers
+    # in the same loop iteration share one commit
+    async def claim(self, session_name: str, job: DeliveryJob):
+        self.claims.append((session_name, job.schedule_id))
+        if self.claim_commit is None:
+            self.claim_commit = asyncio.create_task(self.commit_claims())
+        await asyncio.shield(self.claim_commit)
+
+    async def commit_claims(self):
+        await asyncio.sleep(0)
+        claims, self.claims = self.claims, []
+        self.claim_commit = None
+        async with db.transaction() as conn:
+            await conn.executemany(
+                "UPDATE schedules SET status = 'in_flight', claimed_by = ? WHERE id = ?", claims
+            )
+
+    # Send by numeric id when known; a session that has never met the peer has no access
+    # hash for it, so it falls back to the username once and pyrogram stores the peer
+    async def deliver(self, session_name: str, client: Client, job: DeliveryJob):
+        if job.peer_id is None or username_of(job.chat_id) is None:
+            await send_message_with_session(session_name, client, job.chat_id, job.text, job.media_path)
+            return
+        try:
+            await send_message_with_session(session_name, client, job.peer_id, job.text, job.media_path)
+        except PeerIdInvalid:
+            await send_message_with_session(session_name, client, job.chat_id, job.text, job.media_path)
+
+    # Record finished one-time schedules in one transaction per flush window
+    def schedule_done(self, job: DeliveryJob):
+        self.finished_jobs.append(job)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if not self.flush_pending:
+            self.flush_pending = True
+            asyncio.create_task(self.flush())
+
+    async def flush(self):
+        await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+        self.flush_pending = False
+        finished, self.finished_jobs = self.finished_jobs, []
+        now = time.time()
+        delivered, retries, failed = [], [], []
+        for job in finished:
+            attempts = job.attempts + 1
+            if job.result.result():
+                delivered.append((job.schedule_id,))
+            elif attempts < OUTBOX_MAX_ATTEMPTS and not isinstance(job.error, PERMANENT_SEND_ERRORS):
+                retries.append((attempts, str(job.error), int(now + outbox_backoff(attempts)), job.schedule_id))
+            else:
+                failed.append((attempts, str(job.error), job.schedule_id))
+        try:
+            async with db.transaction() as conn:
+                cursor = await conn.executemany("DELETE FROM schedules WHERE id = ?", delivered)
+                deleted = cursor.rowcount
+                # Row by row, so a schedule cancelled while in flight is not retried
+                pushes = []
+                for retry in retries:
+                    cursor = await conn.execute(
+                        """
+                        UPDATE schedules SET status = 'pending', attempts = ?, last_error = ?, next_run_at = ?,
+                            claimed_by = NULL
+                        WHERE id = ?
+                        """,
+                        retry
+                    )
+                    if cursor.rowcount:
+                        pushes.append((retry[3], retry[2]))
+                await conn.executemany(
+                    "UPDATE schedules SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?", failed
+                )
+            health.schedules_changed(False, -deleted)
+            for schedule_id, next_run_at in pushes:
+                scheduler.push(schedule_id, next_run_at)
+            metrics.inc("bot_outbox_retries_total", len(pushes))
+            metrics.inc("bot_outbox_failed_total", len(failed))
+            logger.info(
+                f"Outbox flush: {len(delivered)} sent and deleted, {len(pushes)} to retry, {len(failed)} failed"
+            )
+        except Exception as e:
+            logger.error(f"Error recording delivery results for {[job.schedule_id for job in finished]}: {e}")
+            # Rolled back: their rows are still in flight, so keep the results for the next flush
+            self.finished_jobs[:0] = finished
+            self.schedule_flush()
+            return
+        for job in finished:
+            self.queued_schedules.pop(job.schedule_id, None)
+
+# Validate a session file; pyrogram opens workdir/<name>.session, so the path is split into directory and stem
+async def validate_session(session_path: str, session_name: str) -> Tuple[bool, str]:
     client = Client(
-        name=session_path,
+        name=os.path.splitext(os.path.basename(session_path))[0],
         api_id=API_ID,
         api_hash=API_HASH,
-        workdir=os.path.dirname(session_path),
-        loop=loop
+        workdir=os.path.dirname(session_path)
     )
     try:
         await client.start()
-        await client.stop()
         logger.info(f"Session {session_name} is valid")
         return True, "Session is alive"
     except AuthKeyUnregistered:
@@ -140,25 +1819,328 @@ async def validate_session(session_path: str, session_name: str, loop: asyncio.A
     except Exception as e:
         logger.error(f"Validation error for {session_name}: {e}")
         return False, f"Validation failed: {e}"
+    finally:
+        # Also runs when the validator's deadline cancels a hung start()
+        await close_client(client, session_name)
+
+# Checks session files concurrently under a deadline and caches results by file hash
+class SessionValidator:
+    def __init__(self, pool: SessionPool):
+        self.pool = pool
+        self.limit = asyncio.Semaphore(MAX_CONCURRENT_VALIDATIONS)
+        # Keyed by session name and fingerprint, which validating the file doesn't change
+        self.cache: Dict[Tuple[str, str], Tuple[float, bool, str]] = {}
+
+    async def validate(self, session_path: str, session_name: str) -> Tuple[bool, str]:
+        client = self.pool.clients.get(session_name)
+        if client and client.is_connected:
+            return True, "Session is connected"
+        fingerprint = await asyncio.get_running_loop().run_in_executor(None, session_fingerprint, session_path)
+        key = (session_name, fingerprint)
+        cached = self.cache.get(key)
+        if cached and cached[0] > time.time():
+            logger.info(f"Using cached validation result for {session_name}")
+            return cached[1], cached[2]
+        async with self.limit:
+            try:
+                is_valid, status = await asyncio.wait_for(
+                    validate_session(session_path, session_name),
+                    VALIDATION_TIMEOUT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                logger.error(f"Validation of {session_name} timed out")
+                return False, f"Validation timed out after {VALIDATION_TIMEOUT_SECONDS} seconds"
+        await record_session_status(session_name, status)
+        now = time.time()
+        self.cache = {k: entry for k, entry in self.cache.items() if entry[0] > now}
+        self.cache[key] = (now + VALIDATION_CACHE_TTL, is_valid, status)
+        return is_valid, status
 
-# Check and send scheduled messages
-async def check_scheduled_messages(clients: List[Client]):
-    current_time = datetime.now()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT id, chat_id, text, media_path, schedule_time FROM schedules WHERE is_recurring = 0"
+    async def validate_many(
+        self, sessions: List[Tuple[str, str]], progress: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> List[Tuple[bool, str]]:
+        done = 0
+
+        async def validate_one(path: str, name: str) -> Tuple[bool, str]:
+            nonlocal done
+            result = await self.validate(path, name)
+            done += 1
+            if progress:
+                await progress(done)
+            return result
+
+        return await asyncio.gather(*(validate_one(path, name) for path, name in sessions))
+
+# Queue one-time schedules that are due for delivery
+async def check_scheduled_messages(dispatcher: Dispatcher) -> List[int]:
+    current_time = int(time.time())
+    queued = []
+    cursor_time, cursor_id = 0, 0
+    while True:
+        schedules = await db.fetchall(
+            """
+            SELECT id, chat_id, text, media_path, next_run_at, peer_id, attempts, idempotency_key FROM schedules
+            WHERE is_recurring = 0 AND status = 'pending' AND next_run_at <= ? AND (next_run_at, id) > (?, ?)
+            ORDER BY next_run_at, id
+            LIMIT ?
+            """,
+            (current_time, cursor_time, cursor_id, DISPATCH_BATCH_SIZE)
         )
-        schedules = await cursor.fetchall()
-        for schedule_id, chat_id, text, media_path, schedule_time in schedules:
+        for schedule_id, chat_id, text, media_path, next_run_at, peer_id, attempts, key in schedules:
+            if schedule_id not in dispatcher.queued_schedules:
+                dispatcher.submit(DeliveryJob(chat_id, text, media_path, schedule_id, next_run_at, peer_id, attempts, key))
+                queued.append(schedule_id)
+        if len(schedules) < DISPATCH_BATCH_SIZE:
+            break
+        cursor_time, cursor_id = schedules[-1][4], schedules[-1][0]
+    if queued:
+        logger.info(f"Queued {len(queued)} due one-time schedules")
+    return queued
+
+# Sleeps until the earliest one-time schedule is due
+class Scheduler:
+    def __init__(self):
+        self.heap: List[Tuple[float, int]] = []
+        self.due_times: Dict[int, float] = {}
+        self.wakeup = asyncio.Event()
+
+    # Load pending one-time schedules from the database
+    async def load(self):
+        for schedule_id, next_run_at in await db.fetchall(
+            "SELECT id, next_run_at FROM schedules WHERE is_recurring = 0 AND status = 'pending'"
+        ):
+            self.push(schedule_id, next_run_at)
+        logger.info(f"Scheduler loaded {len(self.due_times)} one-time schedules")
+
+    # Track a schedule and wake the loop if it is the new head
+    def push(self, schedule_id: int, due: float):
+        self.due_times[schedule_id] = due
+        heapq.heappush(self.heap, (due, schedule_id))
+        if self.heap[0] == (due, schedule_id):
+            self.wakeup.set()
+
+    # Forget a schedule; its heap entry is dropped lazily
+    def discard(self, schedule_id: int):
+        if self.due_times.pop(schedule_id, None) is not None:
+            self.wakeup.set()
+
+    # Earliest live due time, skipping cancelled or rescheduled entries
+    def next_due(self) -> Optional[float]:
+        while self.heap:
+            due, schedule_id = self.heap[0]
+            if self.due_times.get(schedule_id) == due:
+                return due
+            heapq.heappop(self.heap)
+        return None
+
+    async def run(self, dispatcher: Dispatcher):
+        while True:
+            self.wakeup.clear()
+            due = self.next_due()
+            delay = None if due is None else due - time.time()
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
             try:
-                schedule_time = datetime.strptime(schedule_time, "%Y-%m-%d %H:%M:%S")
-                if schedule_time <= current_time:
-                    await send_message_with_session(clients, chat_id, text, media_path)
-                    await db.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,))
-                    await db.commit()
-                    logger.info(f"Sent and deleted one-time schedule {schedule_id}")
+                for schedule_id in await check_scheduled_messages(dispatcher):
+                    self.due_times.pop(schedule_id, None)
             except Exception as e:
-                logger.error(f"Error processing schedule {schedule_id}: {e}")
+                logger.error(f"Error in scheduler: {e}")
+            # Anything still due failed to send; retry it later
+            now = time.time()
+            while (due := self.next_due()) is not None and due <= now:
+                _, schedule_id = heapq.heappop(self.heap)
+                self.push(schedule_id, now + SCHEDULE_RETRY_SECONDS)
+
+# A recurring schedule armed as its own timer on the event loop
+class RecurringJob:
+    def __init__(
+        self,
+        schedule_id: int,
+        chat_id: str,
+        text: str,
+        media_path: Optional[str],
+        interval: int,
+        peer_id: Optional[int] = None
+    ):
+        self.schedule_id = schedule_id
+        self.chat_id = chat_id
+        self.text = text
+        self.media_path = media_path
+        self.interval = interval
+        self.peer_id = peer_id
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.next_run_at = 0.0
+        # At most one run in flight; slots that come due meanwhile are counted in pending
+        self.task: Optional[asyncio.Task] = None
+        self.pending = 0
+        self.due_at = 0.0
+
+# Recurring jobs keyed by schedule id
+class RecurringRegistry:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.jobs: Dict[int, RecurringJob] = {}
+
+    # Arm every recurring schedule stored in the database
+    async def load(self):
+        rows = await db.fetchall(
+            """
+            SELECT id, chat_id, text, media_path, interval_seconds, next_run_at, peer_id
+            FROM schedules WHERE is_recurring = 1
+            """
+        )
+        for schedule_id, chat_id, text, media_path, interval, next_run_at, peer_id in rows:
+            self.add(RecurringJob(schedule_id, chat_id, text, media_path, interval, peer_id), next_run_at)
+        logger.info(f"Loaded {len(self.jobs)} recurring schedules")
+
+    def add(self, job: RecurringJob, next_run_at: float):
+        self.remove(job.schedule_id)
+        self.jobs[job.schedule_id] = job
+        self.arm(job, next_run_at)
+
+    def remove(self, schedule_id: int) -> bool:
+        job = self.jobs.pop(schedule_id, None)
+        if not job:
+            return False
+        if job.handle:
+            job.handle.cancel()
+        return True
+
+    def arm(self, job: RecurringJob, when: float):
+        job.next_run_at = when
+        job.handle = self.loop.call_later(max(when - time.time(), 0), self.fire, job)
+
+    # Next runs stay on the grid anchored at the stored next_run_at, however late this fires
+    def fire(self, job: RecurringJob):
+        if self.jobs.get(job.schedule_id) is not job:
+            return
+        now = time.time()
+        missed = max(int((now - job.next_run_at) // job.interval), 0)
+        latest_due = job.next_run_at + missed * job.interval
+        self.arm(job, latest_due + job.interval)
+        busy = job.task is not None and not job.task.done()
+        if MISFIRE_POLICY == "skip" and (busy or now - latest_due > MISFIRE_GRACE_SECONDS):
+            metrics.inc("bot_recurring_misfires_total", missed + 1, policy=MISFIRE_POLICY)
+            logger.warning(
+                f"Skipped {missed + 1} runs of recurring schedule {job.schedule_id}",
+                extra={"chat": job.chat_id, "schedule_id": job.schedule_id}
+            )
+            return
+        if busy or missed:
+            metrics.inc("bot_recurring_misfires_total", missed + int(busy), policy=MISFIRE_POLICY)
+        if MISFIRE_POLICY == "catchup":
+            job.pending = min(job.pending + missed + 1, MISFIRE_CATCHUP_LIMIT)
+        else:
+            job.pending = 1
+        job.due_at = latest_due
+        if not busy:
+            job.task = asyncio.create_task(self.run(job))
+
+    async def run(self, job: RecurringJob):
+        while job.pending and self.jobs.get(job.schedule_id) is job:
+            job.pending -= 1
+            try:
+                await dispatcher.send(job.chat_id, job.text, job.media_path, job.due_at, job.peer_id)
+                async with db.transaction() as conn:
+                    await conn.execute(
+                        "UPDATE schedules SET next_run_at = ? WHERE id = ?", (int(job.next_run_at), job.schedule_id)
+                    )
+            except Exception as e:
+                logger.error(
+                    f"Error running recurring schedule {job.schedule_id}: {e}",
+                    extra={"chat": job.chat_id, "schedule_id": job.schedule_id}
+                )
+
+# A long admin command running in the background, reporting into its acknowledgement message
+class AdminJob:
+    def __init__(self, job_id: int, name: str, reply):
+        self.job_id = job_id
+        self.name = name
+        self.reply = reply
+        self.status = "queued"
+        self.progress = "queued"
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.last_edit = 0.0
+
+    # Edit the acknowledgement; progress edits are throttled, the final result always goes out
+    async def update(self, text: str, final: bool = False):
+        self.progress = text
+        now = time.monotonic()
+        if not final and now - self.last_edit < JOB_PROGRESS_INTERVAL:
+            return
+        self.last_edit = now
+        try:
+            await self.reply.edit_text(f"[job {self.job_id}] {text}")
+        except Exception as e:
+            logger.warning(f"Could not update job {self.job_id} message: {e}")
+
+# Runs admin jobs under a concurrency limit and remembers recent ones for /jobs
+class JobRunner:
+    def __init__(self):
+        self.jobs: Dict[int, AdminJob] = {}
+        self.next_id = 1
+        self.limit = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+
+    # Acknowledge at once; work(job) runs in the background and returns the final text
+    async def start(self, message, name: str, work: Callable[[AdminJob], Awaitable[str]]) -> AdminJob:
+        job_id, self.next_id = self.next_id, self.next_id + 1
+        reply = await message.reply(f"[job {job_id}] {name}: queued")
+        job = AdminJob(job_id, name, reply)
+        self.jobs[job_id] = job
+        job.task = asyncio.create_task(self.run(job, work))
+        self.prune()
+        return job
+
+    async def run(self, job: AdminJob, work: Callable[[AdminJob], Awaitable[str]]):
+        try:
+            async with self.limit:
+                job.status = "running"
+                await job.update(f"{job.name}: running")
+                result = await work(job)
+            job.status = "done"
+            await job.update(result, final=True)
+            logger.info(f"Job {job.job_id} ({job.name}) finished")
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            await job.update(f"{job.name}: cancelled", final=True)
+            logger.info(f"Job {job.job_id} ({job.name}) cancelled")
+        except Exception as e:
+            job.status = "failed"
+            await job.update(f"Error: {e}", final=True)
+            logger.error(f"Job {job.job_id} ({job.name}) failed: {e}")
+        finally:
+            job.finished_at = time.time()
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if not job or job.finished_at is not None:
+            return False
+        job.task.cancel()
+        return True
+
+    # Keep every unfinished job and the last JOB_HISTORY finished ones
+    def prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[:-JOB_HISTORY]:
+            del self.jobs[job_id]
+
+    def render(self) -> str:
+        if not self.jobs:
+            return "No jobs."
+        now = time.time()
+        response = "Jobs:\n"
+        for job in self.jobs.values():
+            elapsed = (job.finished_at or now) - job.started_at
+            response += f"{job.job_id}: {job.name} - {job.status} ({elapsed:.0f}s) {job.progress}\n"
+        return response
+
+jobs = JobRunner()
 
 # Handle non-admin users
 @bot.on_message(~filters.user(ADMIN_ID))
@@ -168,57 +2150,103 @@ async def handle_non_admin(client, message):
 
 # Command to add a session by uploading a file
 @bot.on_message(filters.command("addsession") & filters.user(ADMIN_ID))
+@timed_command("addsession")
 async def add_session(client, message):
     await message.reply("Please upload a .session file.")
     logger.info("Admin requested to add a session")
 
 # Handle uploaded session file
 @bot.on_message(filters.document & filters.user(ADMIN_ID))
+@timed_command("session_upload")
 async def handle_session_upload(client, message):
     if not message.document.file_name.endswith(".session"):
         await message.reply("Please upload a valid .session file.")
         logger.warning(f"Invalid file uploaded: {message.document.file_name}")
         return
-    temp_path = f"temp_{message.document.file_name}"
-    try:
-        await message.download(file_name=temp_path)
-        session_name = f"user_{int(time.time())}"
-        session_path = os.path.join(SESSION_DIR, f"{session_name}.session")
-        is_valid, status = await validate_session(temp_path, session_name, client.loop)
-        if is_valid:
-            os.rename(temp_path, session_path)
-            await message.reply(f"Session {session_name}.session is alive and stored!")
+    session_name = f"user_{int(time.time())}"
+    session_path = os.path.join(SESSION_DIR, f"{session_name}.session")
+    # Stage under the same name in UPLOAD_DIR: pyrogram needs a .session file to validate,
+    # and the move into SESSION_DIR stays an atomic same-filesystem replace
+    temp_path = os.path.join(UPLOAD_DIR, f"{session_name}.session")
+
+    async def work(job: AdminJob) -> str:
+        try:
+            await job.update("Downloading session file...")
+            await message.download(file_name=os.path.abspath(temp_path))
+            await job.update("Validating session...")
+            is_valid, status = await validator.validate(temp_path, session_name)
+            if not is_valid:
+                logger.warning(f"Invalid session uploaded: {status}")
+                return f"Session is invalid: {status}"
+            file_hash = await asyncio.get_running_loop().run_in_executor(None, session_fingerprint, temp_path)
+            os.replace(temp_path, session_path)
+            await register_session(session_name, file_hash, status)
+            if session_name not in pool.clients:
+                await job.update("Connecting session...")
+                pool.park(session_name)
+                await pool.activate(session_name)
             logger.info(f"Stored session {session_name}.session")
-        else:
-            await message.reply(f"Session is invalid: {status}")
-            logger.warning(f"Invalid session uploaded: {status}")
+            return f"Session {session_name}.session is alive and stored!"
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+                logger.info(f"Cleaned up temporary file {temp_path}")
+
+    try:
+        await jobs.start(message, "addsession", work)
     except Exception as e:
         await message.reply(f"Error processing session: {e}")
         logger.error(f"Error processing session upload: {e}")
-    finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-            logger.info(f"Cleaned up temporary file {temp_path}")
+
+# Command to re-check every stored session at once
+@bot.on_message(filters.command("validatesessions") & filters.user(ADMIN_ID))
+@timed_command("validatesessions")
+async def validate_sessions(client, message):
+    try:
+        sessions = await list_sessions(include_disabled=True)
+        if not sessions:
+            await message.reply("No sessions to validate.")
+            return
+
+        async def work(job: AdminJob) -> str:
+            results = await validator.validate_many(
+                [(os.path.join(SESSION_DIR, f"{name}.session"), name) for name in sessions],
+                lambda done: job.update(f"Validated {done}/{len(sessions)} sessions")
+            )
+            response = "Session Validation:\n"
+            for session_name, (is_valid, status) in zip(sessions, results):
+                response += f"{session_name}.session: {'OK' if is_valid else 'FAILED'} - {status}\n"
+            logger.info(f"Validated {len(sessions)} sessions")
+            return response
+
+        await jobs.start(message, "validatesessions", work)
+    except Exception as e:
+        await message.reply(f"Error: {e}")
+        logger.error(f"Error in validatesessions command: {e}")
 
 # Command to send a text message
 @bot.on_message(filters.command("send") & filters.user(ADMIN_ID))
+@timed_command("send")
 async def send_message(client, message):
     try:
         _, chat_id, *text = message.text.split(maxsplit=2)
         chat_id = int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id
         text = text[0] if text else "Hello!"
-        clients = await load_session_clients(client.loop)
-        if await send_message_with_session(clients, chat_id, text):
-            await message.reply("Message sent!")
-        else:
-            await message.reply("Failed to send message.")
-        logger.info(f"Send command executed for chat {chat_id}")
+
+        async def work(job: AdminJob) -> str:
+            await job.update(f"Sending to {chat_id}...")
+            sent = await dispatcher.send(chat_id, text)
+            logger.info(f"Send command executed for chat {chat_id}")
+            return "Message sent!" if sent else "Failed to send message."
+
+        await jobs.start(message, "send", work)
     except Exception as e:
         await message.reply(f"Error: {e}")
         logger.error(f"Error in send command: {e}")
 
 # Command to send media
 @bot.on_message(filters.command("sendmedia") & filters.user(ADMIN_ID))
+@timed_command("sendmedia")
 async def send_media(client, message):
     try:
         _, chat_id, media_path, *caption = message.text.split(maxsplit=3)
@@ -228,28 +2256,31 @@ async def send_media(client, message):
             await message.reply("Media file not found.")
             logger.warning(f"Media file not found: {media_path}")
             return
-        clients = await load_session_clients(client.loop)
-        if await send_message_with_session(clients, chat_id, caption, message.document.file_id):
-            await message.reply("Media sent!")
-        else:
-            await message.reply("Failed to send media.")
-        logger.info(f"Sendmedia command executed for chat {chat_id}")
+
+        async def work(job: AdminJob) -> str:
+            await job.update(f"Sending {os.path.basename(media_path)} to {chat_id}...")
+            sent = await dispatcher.send(chat_id, caption, media_path)
+            logger.info(f"Sendmedia command executed for chat {chat_id}")
+            return "Media sent!" if sent else "Failed to send media."
+
+        await jobs.start(message, "sendmedia", work)
     except Exception as e:
         await message.reply(f"Error: {e}")
         logger.error(f"Error in sendmedia command: {e}")
 
 # Command to edit a message
 @bot.on_message(filters.command("edit") & filters.user(ADMIN_ID))
+@timed_command("edit")
 async def edit_message(client, message):
     try:
         _, chat_id, message_id, *new_text = message.text.split(maxsplit=3)
         chat_id = int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id
         message_id = int(message_id)
         new_text = new_text[0] if new_text else "Edited message"
-        clients = await load_session_clients(client.loop)
-        if clients:
-            client = await get_next_client(clients)
-            await client.edit_message_text(chat_id, message_id, new_text)
+        async with pool.borrow() as session_client:
+            if session_client:
+                await session_client.edit_message_text(chat_id, message_id, new_text)
+        if session_client:
             await message.reply("Message edited!")
             logger.info(f"Edited message {message_id} in chat {chat_id}")
         else:
@@ -261,18 +2292,21 @@ async def edit_message(client, message):
 
 # Command to schedule a one-time message
 @bot.on_message(filters.command("schedule") & filters.user(ADMIN_ID))
+@timed_command("schedule")
 async def schedule_message(client, message):
     try:
         parts = message.text.split(maxsplit=4)
-        if len(parts) < 4:
-            await message.reply("Usage: /schedule <chat_id> <time> <message> [media_path]")
+        if len(parts) < 5:
+            await message.reply(f"Usage: /schedule <chat_id> <YYYY-MM-DD HH:MM> <message> [{MEDIA_ARG}<file in {MEDIA_DIR}/>]")
             return
-        _, chat_id, time_str, text, *media_path = parts
+        _, chat_id, date_str, clock_str, text = parts
+        time_str = f"{date_str} {clock_str}"
         chat_id = int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id
-        media_path = media_path[0] if media_path else None
-        if media_path and not os.path.exists(media_path):
+        text, media_name = split_media_arg(text)
+        media_path = media_dir_file(media_name) if media_name else None
+        if media_name is not None and not media_path:
             await message.reply("Media file not found.")
-            logger.warning(f"Media file not found: {media_path}")
+            logger.warning(f"Media file not found: {media_name}")
             return
         try:
             schedule_time = datetime.strptime(time_str, "%Y-%m-%d %H:%M")
@@ -280,15 +2314,24 @@ async def schedule_message(client, message):
             await message.reply("Invalid time format. Use YYYY-MM-DD HH:MM")
             logger.warning(f"Invalid time format: {time_str}")
             return
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
+        due = int(schedule_time.timestamp())
+        try:
+            peer_id = await resolve_peer_id(chat_id)
+        except RPCError as e:
+            # Store it unresolved; the sending session resolves the username itself
+            peer_id = None
+            logger.warning(f"Could not resolve {chat_id}: {e}")
+        async with db.transaction() as conn:
+            cursor = await conn.execute(
                 """
-                INSERT INTO schedules (chat_id, text, media_path, schedule_time, is_recurring)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO schedules
+                    (chat_id, text, media_path, schedule_time, is_recurring, next_run_at, peer_id, idempotency_key)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 """,
-                (chat_id, text, media_path, schedule_time.strftime("%Y-%m-%d %H:%M:%S"), False)
+                (chat_id, text, media_path, due, False, due, peer_id, new_idempotency_key())
             )
-            await db.commit()
+        health.schedules_changed(False, 1)
+        scheduler.push(cursor.lastrowid, due)
         await message.reply("Message scheduled!")
         logger.info(f"One-time message scheduled for {chat_id} at {time_str}")
     except Exception as e:
@@ -297,63 +2340,96 @@ async def schedule_message(client, message):
 
 # Command to schedule recurring messages
 @bot.on_message(filters.command("recurring") & filters.user(ADMIN_ID))
+@timed_command("recurring")
 async def schedule_recurring(client, message):
     try:
-        parts = message.text.split(maxsplit=4)
+        parts = message.text.split(maxsplit=3)
         if len(parts) < 4:
-            await message.reply("Usage: /recurring <chat_id> <interval> <message> [media_path]")
+            await message.reply(f"Usage: /recurring <chat_id> <interval> <message> [{MEDIA_ARG}<file in {MEDIA_DIR}/>]")
             return
-        _, chat_id, interval, text, *media_path = parts
+        _, chat_id, interval, text = parts
         chat_id = int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id
-        media_path = media_path[0] if media_path else None
-        if media_path and not os.path.exists(media_path):
+        text, media_name = split_media_arg(text)
+        media_path = media_dir_file(media_name) if media_name else None
+        if media_name is not None and not media_path:
             await message.reply("Media file not found.")
-            logger.warning(f"Media file not found: {media_path}")
+            logger.warning(f"Media file not found: {media_name}")
             return
         if interval not in ["1m", "30m", "1h"]:
             await message.reply("Interval must be 1m, 30m, or 1h")
             logger.warning(f"Invalid interval: {interval}")
             return
         seconds = {"1m": 60, "30m": 1800, "1h": 3600}[interval]
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
+        next_run_at = int(time.time()) + seconds
+        try:
+            peer_id = await resolve_peer_id(chat_id)
+        except RPCError as e:
+            # Store it unresolved; the sending session resolves the username itself
+            peer_id = None
+            logger.warning(f"Could not resolve {chat_id}: {e}")
+        async with db.transaction() as conn:
+            cursor = await conn.execute(
                 """
-                INSERT INTO schedules (chat_id, text, media_path, interval_seconds, is_recurring)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO schedules (chat_id, text, media_path, interval_seconds, is_recurring, next_run_at, peer_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
                 """,
-                (chat_id, text, media_path, seconds, True)
+                (chat_id, text, media_path, seconds, True, next_run_at, peer_id)
             )
-            await db.commit()
-        async def recurring_task():
-            clients = await load_session_clients(client.loop)
-            await send_message_with_session(clients, chat_id, text, media_path)
-        schedule.every(seconds).seconds.do(lambda: asyncio.create_task(recurring_task()))
+        health.schedules_changed(True, 1)
+        recurring.add(RecurringJob(cursor.lastrowid, chat_id, text, media_path, seconds, peer_id), next_run_at)
         await message.reply(f"Recurring message scheduled every {interval}!")
         logger.info(f"Recurring message scheduled for {chat_id} every {interval}")
     except Exception as e:
         await message.reply(f"Error: {e}")
         logger.error(f"Error in recurring command: {e}")
 
+# Render one page of schedules after (or before) a schedule id, with Prev/Next buttons
+async def render_schedule_page(
+    after_id: int = 0, before_id: Optional[int] = None
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    columns = "id, chat_id, text, media_path, schedule_time, interval_seconds, is_recurring, status, attempts, last_error"
+    if before_id is not None:
+        schedules = await db.fetchall(
+            f"SELECT {columns} FROM schedules WHERE id < ? ORDER BY id DESC LIMIT ?",
+            (before_id, LIST_PAGE_SIZE)
+        )
+        schedules.reverse()
+    else:
+        schedules = await db.fetchall(
+            f"SELECT {columns} FROM schedules WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, LIST_PAGE_SIZE)
+        )
+    if not schedules:
+        return "No active schedules.", None
+    response = "Active Schedules:\n"
+    for s in schedules:
+        schedule_id, chat_id, text, media_path, schedule_time, interval, is_recurring, status, attempts, last_error = s
+        if is_recurring:
+            interval_str = f"every {interval} seconds"
+        else:
+            interval_str = f"at {datetime.fromtimestamp(schedule_time).strftime('%Y-%m-%d %H:%M')}"
+        if len(text) > LIST_PREVIEW_CHARS:
+            text = text[:LIST_PREVIEW_CHARS] + "..."
+        response += f"ID: {schedule_id}, Chat: {chat_id}, Text: {text}, Media: {media_path or 'None'}, Time: {interval_str}\n"
+        if status == "failed":
+            response += f"  Failed after {attempts} attempts: {last_error}\n"
+        elif attempts:
+            response += f"  Retrying, {attempts} failed attempts: {last_error}\n"
+    first_id, last_id = schedules[0][0], schedules[-1][0]
+    buttons = []
+    if await db.fetchone("SELECT 1 FROM schedules WHERE id < ? LIMIT 1", (first_id,)):
+        buttons.append(InlineKeyboardButton("Prev", callback_data=f"schedules_prev_{first_id}"))
+    if await db.fetchone("SELECT 1 FROM schedules WHERE id > ? LIMIT 1", (last_id,)):
+        buttons.append(InlineKeyboardButton("Next", callback_data=f"schedules_next_{last_id}"))
+    return response, InlineKeyboardMarkup([buttons]) if buttons else None
+
 # Command to list schedules
 @bot.on_message(filters.command("listschedules") & filters.user(ADMIN_ID))
+@timed_command("listschedules")
 async def list_schedules(client, message):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT id, chat_id, text, media_path, schedule_time, interval_seconds, is_recurring FROM schedules")
-            schedules = await cursor.fetchall()
-        if not schedules:
-            await message.reply("No active schedules.")
-            logger.info("No active schedules found")
-            return
-        response = "Active Schedules:\n"
-        for s in schedules:
-            schedule_id, chat_id, text, media_path, schedule_time, interval, is_recurring = s
-            if is_recurring:
-                interval_str = f"every {interval} seconds"
-            else:
-                interval_str = f"at {schedule_time}"
-            response += f"ID: {schedule_id}, Chat: {chat_id}, Text: {text}, Media: {media_path or 'None'}, Time: {interval_str}\n"
-        await message.reply(response)
+        response, keyboard = await render_schedule_page()
+        await message.reply(response, reply_markup=keyboard)
         logger.info("Listed active schedules")
     except Exception as e:
         await message.reply(f"Error: {e}")
@@ -361,28 +2437,25 @@ async def list_schedules(client, message):
 
 # Command to cancel a schedule
 @bot.on_message(filters.command("cancelschedule") & filters.user(ADMIN_ID))
+@timed_command("cancelschedule")
 async def cancel_schedule(client, message):
     try:
         _, schedule_id = message.text.split(maxsplit=1)
         schedule_id = int(schedule_id)
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT is_recurring FROM schedules WHERE id = ?", (schedule_id,))
-            result = await cursor.fetchone()
-            if not result:
-                await message.reply("Schedule not found.")
-                logger.warning(f"Schedule {schedule_id} not found")
-                return
-            await db.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,))
-            await db.commit()
-        schedule.clear()  # Clear and reload recurring schedules
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT chat_id, text, media_path, interval_seconds FROM schedules WHERE is_recurring = 1")
-            recurring = await cursor.fetchall()
-            for chat_id, text, media_path, seconds in recurring:
-                async def recurring_task():
-                    clients = await load_session_clients(client.loop)
-                    await send_message_with_session(clients, chat_id, text, media_path)
-                schedule.every(seconds).seconds.do(lambda: asyncio.create_task(recurring_task()))
+        result = await db.fetchone("SELECT is_recurring, chat_id FROM schedules WHERE id = ?", (schedule_id,))
+        if not result:
+            await message.reply("Schedule not found.")
+            logger.warning(f"Schedule {schedule_id} not found")
+            return
+        async with db.transaction() as conn:
+            await conn.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,))
+        health.schedules_changed(result[0], -1)
+        history.record(None, result[1], schedule_id, OUTCOME_CANCELLED)
+        if result[0]:
+            recurring.remove(schedule_id)
+        else:
+            scheduler.discard(schedule_id)
+            dispatcher.cancel_schedule(schedule_id)
         await message.reply(f"Schedule {schedule_id} cancelled.")
         logger.info(f"Cancelled schedule {schedule_id}")
     except Exception as e:
@@ -391,6 +2464,7 @@ async def cancel_schedule(client, message):
 
 # Command to send a message with inline buttons
 @bot.on_message(filters.command("buttons") & filters.user(ADMIN_ID))
+@timed_command("buttons")
 async def send_buttons(client, message):
     try:
         _, chat_id, *text = message.text.split(maxsplit=2)
@@ -400,10 +2474,10 @@ async def send_buttons(client, message):
             [InlineKeyboardButton("Confirm", callback_data="confirm")],
             [InlineKeyboardButton("Cancel", callback_data="cancel")]
         ])
-        clients = await load_session_clients(client.loop)
-        if clients:
-            client = await get_next_client(clients)
-            await client.send_message(chat_id, text, reply_markup=keyboard)
+        async with pool.borrow() as session_client:
+            if session_client:
+                await session_client.send_message(chat_id, text, reply_markup=keyboard)
+        if session_client:
             await message.reply("Message with buttons sent!")
             logger.info(f"Sent message with buttons to {chat_id}")
         else:
@@ -415,6 +2489,7 @@ async def send_buttons(client, message):
 
 # Command to manage sessions
 @bot.on_message(filters.command("managesessions") & filters.user(ADMIN_ID))
+@timed_command("managesessions")
 async def manage_sessions(client, message):
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("Add Session", callback_data="add_session")],
@@ -425,27 +2500,120 @@ async def manage_sessions(client, message):
 
 # Command to check bot status
 @bot.on_message(filters.command("status") & filters.user(ADMIN_ID))
+@timed_command("status")
 async def check_status(client, message):
     try:
-        clients = await load_session_clients(client.loop)
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT COUNT(*) FROM schedules")
-            schedule_count = (await cursor.fetchone())[0]
-        sessions = [f for f in os.listdir(SESSION_DIR) if f.endswith(".session")]
+        states = [h.current_state() for h in health.sessions.values()]
         response = (
             f"Bot Status:\n"
-            f"Active Sessions: {len(clients)}/{len(sessions)}\n"
-            f"Total Schedules: {schedule_count}\n"
+            f"Active Sessions: {states.count('connected')}/{len(states)}\n"
+            f"Flood Cooling: {states.count('flood-cooling')}, Auth Dead: {states.count('auth-dead')}, "
+            f"Parked: {states.count('parked')}\n"
+            f"Total Schedules: {health.one_time_schedules + health.recurring_schedules} "
+            f"({health.one_time_schedules} one-time, {health.recurring_schedules} recurring)\n"
             f"Uptime: {datetime.now() - bot_start_time}"
         )
+        if len(message.command) > 1 and message.command[1] == "sessions":
+            response += "\n\n" + health.render_sessions()
         await message.reply(response)
         logger.info("Status command executed")
     except Exception as e:
         await message.reply(f"Error: {e}")
         logger.error(f"Error in status command: {e}")
 
+# Command to profile the event loop thread for a few seconds
+@bot.on_message(filters.command("profile") & filters.user(ADMIN_ID))
+@timed_command("profile")
+async def profile_loop(client, message):
+    try:
+        if len(message.command) < 2 or not message.command[1].isdigit():
+            await message.reply(f"Usage: /profile <seconds> (max {PROFILE_MAX_SECONDS})")
+            return
+        if profile_lock.locked():
+            await message.reply("A profile is already running.")
+            return
+        seconds = min(int(message.command[1]), PROFILE_MAX_SECONDS)
+
+        async def work(job: AdminJob) -> str:
+            async with profile_lock:
+                await job.update(f"Profiling for {seconds} seconds...")
+                # Everything the loop runs meanwhile executes on this thread, so it is all captured
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profiler.disable()
+            report = io.StringIO()
+            stats = pstats.Stats(profiler, stream=report)
+            report.write(f"Event loop profile over {seconds} seconds, by own time\n")
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_TOP_FUNCTIONS)
+            report.write("By cumulative time\n")
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_FUNCTIONS)
+            document = io.BytesIO(report.getvalue().encode())
+            await message.reply_document(document, file_name="profile.txt")
+            logger.info(f"Profile command executed for {seconds} seconds")
+            return f"Profile of {seconds} seconds sent."
+
+        await jobs.start(message, "profile", work)
+    except Exception as e:
+        await message.reply(f"Error: {e}")
+        logger.error(f"Error in profile command: {e}")
+
+# Command to list background jobs or cancel one
+@bot.on_message(filters.command("jobs") & filters.user(ADMIN_ID))
+@timed_command("jobs")
+async def list_jobs(client, message):
+    try:
+        if len(message.command) > 1 and message.command[1] == "cancel":
+            if len(message.command) < 3 or not message.command[2].isdigit():
+                await message.reply("Usage: /jobs cancel <job_id>")
+                return
+            job_id = int(message.command[2])
+            if jobs.cancel(job_id):
+                await message.reply(
+                    f"Job {job_id} cancelled. Deliveries still queued are dropped; one already sending can't be recalled."
+                )
+                logger.info(f"Cancelled job {job_id}")
+            else:
+                await message.reply("Job not found or already finished.")
+            return
+        await message.reply(jobs.render())
+        logger.info("Jobs command executed")
+    except Exception as e:
+        await message.reply(f"Error: {e}")
+        logger.error(f"Error in jobs command: {e}")
+
+# Command to summarise deliveries from the daily rollups
+@bot.on_message(filters.command("stats") & filters.user(ADMIN_ID))
+@timed_command("stats")
+async def show_stats(client, message):
+    try:
+        days = int(message.command[1]) if len(message.command) > 1 and message.command[1].isdigit() else 7
+        days = min(max(days, 1), ROLLUP_RETENTION_DAYS)
+        await history.flush()
+        await message.reply(await history.render_stats(days))
+        logger.info(f"Stats command executed for {days} days")
+    except Exception as e:
+        await message.reply(f"Error: {e}")
+        logger.error(f"Error in stats command: {e}")
+
+# Command to dump the metrics registry
+@bot.on_message(filters.command("metrics") & filters.user(ADMIN_ID))
+@timed_command("metrics")
+async def show_metrics(client, message):
+    try:
+        update_gauges()
+        document = io.BytesIO(metrics.render().encode())
+        await message.reply_document(document, file_name="metrics.prom")
+        logger.info("Metrics command executed")
+    except Exception as e:
+        await message.reply(f"Error: {e}")
+        logger.error(f"Error in metrics command: {e}")
+
 # Handle button callbacks
 @bot.on_callback_query()
+@timed_command("callback")
 async def handle_callback(client, callback_query):
     data = callback_query.data
     if callback_query.from_user.id != ADMIN_ID:
@@ -463,7 +2631,7 @@ async def handle_callback(client, callback_query):
             await callback_query.message.edit_text("Use /addsession to upload a .session file.")
             logger.info("Add session button clicked")
         elif data == "remove_session":
-            sessions = [f for f in os.listdir(SESSION_DIR) if f.endswith(".session")]
+            sessions = [f"{name}.session" for name in await list_sessions(include_disabled=True)]
             if not sessions:
                 await callback_query.message.edit_text("No sessions available to remove.")
                 logger.info("No sessions available to remove")
@@ -472,11 +2640,23 @@ async def handle_callback(client, callback_query):
             keyboard = InlineKeyboardMarkup(buttons)
             await callback_query.message.edit_text("Select a session to remove:", reply_markup=keyboard)
             logger.info("Remove session button clicked")
+        elif data.startswith("schedules_prev_") or data.startswith("schedules_next_"):
+            schedule_id = int(data.rsplit("_", 1)[1])
+            if data.startswith("schedules_prev_"):
+                response, keyboard = await render_schedule_page(before_id=schedule_id)
+            else:
+                response, keyboard = await render_schedule_page(after_id=schedule_id)
+            await callback_query.message.edit_text(response, reply_markup=keyboard)
+            logger.info(f"Schedules page button clicked: {data}")
         elif data.startswith("delete_"):
             session_file = data[len("delete_"):]
             session_path = os.path.join(SESSION_DIR, session_file)
             try:
-                os.remove(session_path)
+                session_name = os.path.splitext(session_file)[0]
+                await pool.remove(session_name)
+                await unregister_session(session_name)
+                if os.path.exists(session_path):
+                    os.remove(session_path)
                 await callback_query.message.edit_text(f"Session {session_file} removed!")
                 logger.info(f"Removed session {session_file}")
             except Exception as e:
@@ -489,28 +2669,100 @@ async def handle_callback(client, callback_query):
 # Global start time for uptime tracking
 bot_start_time = datetime.now()
 
-# Shutdown handler
-async def shutdown(clients: List[Client]):
-    logger.info("Shutting down bot...")
-    for client in clients:
+# Held while /profile is capturing; only one profiler can be active at a time
+profile_lock = asyncio.Lock()
+
+# Session client pool and schedulers, created in main()
+pool: Optional[SessionPool] = None
+scheduler: Optional[Scheduler] = None
+recurring: Optional[RecurringRegistry] = None
+dispatcher: Optional[Dispatcher] = None
+validator: Optional[SessionValidator] = None
+
+# Refresh gauges that are read from live objects
+def update_gauges():
+    if dispatcher:
+        metrics.set("bot_dispatch_queue_depth", dispatcher.queue.qsize())
+        metrics.set("bot_dispatch_workers", len(dispatcher.workers))
+    if pool:
+        metrics.set("bot_sessions_connected", sum(1 for c in pool.clients.values() if c.is_connected))
+        metrics.set("bot_sessions_parked", len(pool.parked))
+    if scheduler:
+        metrics.set("bot_scheduler_pending", len(scheduler.due_times))
+    if recurring:
+        metrics.set("bot_recurring_jobs", len(recurring.jobs))
+
+# Periodically write the metrics file for scraping
+async def write_metrics_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL_SECONDS)
         try:
-            await client.stop()
-            logger.info(f"Stopped client {client.name}")
+            update_gauges()
+            await loop.run_in_executor(None, metrics.write, METRICS_PATH)
         except Exception as e:
-            logger.error(f"Error stopping client {client.name}: {e}")
+            logger.error(f"Error writing metrics: {e}")
+
+# Reports event loop lag, and logs the loop thread's stack while a callback blocks it
+class LoopWatchdog:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopped = threading.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = self.loop.create_task(self.heartbeat())
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+
+    async def heartbeat(self):
+        try:
+            while True:
+                before = time.monotonic()
+                await asyncio.sleep(LOOP_WATCHDOG_INTERVAL)
+                self.last_beat = time.monotonic()
+                metrics.observe("bot_event_loop_lag_seconds", max(self.last_beat - before - LOOP_WATCHDOG_INTERVAL, 0))
+        finally:
+            self.stopped.set()
+
+    # Runs in its own thread, so it still wakes up while the loop is stuck
+    def watch(self):
+        reported_beat = None
+        while not self.stopped.wait(LOOP_WATCHDOG_INTERVAL):
+            last_beat = self.last_beat
+            blocked = time.monotonic() - last_beat - LOOP_WATCHDOG_INTERVAL
+            if blocked < LOOP_BLOCK_THRESHOLD or last_beat == reported_beat:
+                continue
+            # Once per stall; the stack shows the callback that is still running
+            reported_beat = last_beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unavailable"
+            logger.warning(f"Event loop blocked for {blocked:.2f} seconds, loop thread stack:\n{stack}")
+
+# Shutdown handler
+async def shutdown(pool: Optional[SessionPool]):
+    logger.info("Shutting down bot...")
+    if pool:
+        await pool.stop()
     try:
         await bot.stop()
         logger.info("Bot stopped")
     except Exception as e:
         logger.error(f"Error stopping bot: {e}")
+    try:
+        await history.flush()
+        await db.close()
+    except Exception as e:
+        logger.error(f"Error closing database: {e}")
     tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
     for task in tasks:
         task.cancel()
     logger.info("All tasks cancelled")
 
 # Signal handler for graceful shutdown
-async def handle_shutdown(clients: List[Client]):
-    await shutdown(clients)
+async def handle_shutdown(pool: Optional[SessionPool]):
+    await shutdown(pool)
     loop = asyncio.get_running_loop()
     try:
         await loop.shutdown_asyncgens()
@@ -524,42 +2776,41 @@ async def handle_shutdown(clients: List[Client]):
 
 # Main function to run bot and scheduler
 async def main():
-    global clients
-    clients = []
+    global pool, scheduler, recurring, dispatcher, validator
     loop = asyncio.get_running_loop()
     bot.loop = loop  # Ensure bot uses the same loop
     try:
-        await init_db()
-        # Load recurring schedules from database
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT chat_id, text, media_path, interval_seconds FROM schedules WHERE is_recurring = 1")
-            recurring = await cursor.fetchall()
-            for chat_id, text, media_path, seconds in recurring:
-                async def recurring_task():
-                    clients = await load_session_clients(loop)
-                    await send_message_with_session(clients, chat_id, text, media_path)
-                schedule.every(seconds).seconds.do(lambda: asyncio.create_task(recurring_task()))
+        await db.open()
+        pool = SessionPool(loop)
+        dispatcher = Dispatcher(pool)
+        pool.on_change = dispatcher.sync_workers
+        validator = SessionValidator(pool)
+        scheduler = Scheduler()
+        recurring = RecurringRegistry(loop)
+        await dispatcher.recover()
+        await scheduler.load()
+        await health.load_counts()
+        # Answer admins right away; sessions connect in the background
         await bot.start()
-        clients = await load_session_clients(loop)
+        pool.start_task = asyncio.create_task(pool.start())
+        # Load recurring schedules from database
+        await recurring.load()
+        asyncio.create_task(write_metrics_periodically())
+        asyncio.create_task(history.run())
+        asyncio.create_task(pool.run_idle_eviction())
+        LoopWatchdog(loop).start()
         logger.info("Bot started")
         # Set up signal handlers
         for sig in (signal.SIGINT, signal.SIGTERM):
-            signal.signal(sig, lambda signum, frame: asyncio.create_task(handle_shutdown(clients)))
-        while True:
-            try:
-                await check_scheduled_messages(clients)
-                schedule.run_pending()
-                await asyncio.sleep(60)  # Check every minute
-            except asyncio.CancelledError:
-                logger.info("Main loop cancelled")
-                break
-            except Exception as e:
-                logger.error(f"Error in main loop: {e}")
-                await asyncio.sleep(60)
+            signal.signal(sig, lambda signum, frame: asyncio.create_task(handle_shutdown(pool)))
+        try:
+            await scheduler.run(dispatcher)
+        except asyncio.CancelledError:
+            logger.info("Main loop cancelled")
     except Exception as e:
         logger.error(f"Fatal error in main: {e}")
     finally:
-        await handle_shutdown(clients)
+        await handle_shutdown(pool)
 
 if __name__ == "__main__":
     try: